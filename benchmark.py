@@ -0,0 +1,70 @@
+# Offline micro-benchmarks for the heavier tool paths in main.py.
+#
+# Usage: python benchmark.py ann --rows 100000 --dim 256
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+# main.py refuses to import without a token; the benchmarks make no API calls
+os.environ.setdefault("AIPROXY_TOKEN", "benchmark")
+
+import main
+
+
+def make_corpus(rows: int, dim: int, duplicates: int, seed: int) -> np.ndarray:
+    """Random unit vectors with a few planted near-duplicate pairs, which is
+    what real comment corpora look like to the similarity search."""
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((rows, dim)).astype(np.float32)
+
+    sources = rng.choice(rows, size=duplicates, replace=False)
+    targets = rng.choice(np.setdiff1d(np.arange(rows), sources), size=duplicates, replace=False)
+    noise = rng.uniform(0.05, 0.6, size=(duplicates, 1)).astype(np.float32)
+    vectors[targets] = vectors[sources] + noise * rng.standard_normal((duplicates, dim))
+
+    return main.normalize_rows(vectors)
+
+
+def bench_ann(args):
+    recalls, exact_times, ann_times = [], [], []
+
+    for trial in range(args.trials):
+        vectors = make_corpus(args.rows, args.dim, args.duplicates, seed=trial)
+
+        start = time.perf_counter()
+        exact = main.top_similar_pairs(vectors, args.top_k)
+        exact_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        index = main.LshIndex(args.dim, args.tables, args.bits, seed=trial)
+        hashes = [str(n) for n in range(args.rows)]
+        index.add(hashes, vectors)
+        approx = main.approximate_similar_pairs(vectors, index.codes_for(hashes), args.top_k)
+        ann_times.append(time.perf_counter() - start)
+
+        recalls.append(float(bool(approx) and approx[0][:2] == exact[0][:2]))
+
+    print(f"rows={args.rows} dim={args.dim} tables={args.tables} bits={args.bits}")
+    print(f"exact: {np.mean(exact_times):.3f}s  ann: {np.mean(ann_times):.3f}s")
+    print(f"recall@1: {np.mean(recalls):.3f} over {args.trials} trials")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ann = commands.add_parser("ann", help="LSH similar_comments search vs exact search")
+    ann.add_argument("--rows", type=int, default=20000)
+    ann.add_argument("--dim", type=int, default=256)
+    ann.add_argument("--duplicates", type=int, default=20)
+    ann.add_argument("--tables", type=int, default=main.ANN_TABLES)
+    ann.add_argument("--bits", type=int, default=main.ANN_BITS)
+    ann.add_argument("--top-k", type=int, default=1)
+    ann.add_argument("--trials", type=int, default=5)
+    ann.set_defaults(run=bench_ann)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -1,31 +1,67 @@
-from fastapi import FastAPI, HTTPException, Response
+from fastapi import FastAPI, HTTPException, Query, Response
+from fastapi.concurrency import run_in_threadpool
 import subprocess
 import os
 import json
 import sqlite3
-from datetime import datetime
+from datetime import date, datetime
 from pathlib import Path
 from typing import Optional
 import requests
 import markdown2
 from bs4 import BeautifulSoup
 import openai
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
 from fastapi.middleware.cors import CORSMiddleware
 import httpx
 import os
-from typing import Dict, Any
+from typing import Dict, Any, Union
 from dateutil import parser
 import sys
 import logging
 import re
 import base64
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import heapq
+import functools
+import mmap
+import glob
+import tempfile
+import textwrap
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, closing, contextmanager
+import asyncio
+import csv
+import anyio
 from PIL import Image
 from io import BytesIO
 #import easyocr
 import numpy as np
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_http_client()
+
+    if OCR_PRELOAD:
+        await run_in_threadpool(ocr_pool.preload)
+
+    yield
+    await stop_http_client()
+    shutdown_process_pool()
+    shutdown_ocr_process_pool()
+    stop_markdown_watchers()
+    close_sqlite_pools()
+    prettier_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -63,14 +99,131 @@ if not AIPROXY_TOKEN:
 
 APP_ID = "Smriti-tds-project"
 
+# Shared, pooled HTTP client for all AI proxy calls
+HTTP_MAX_CONNECTIONS: int = int(os.environ.get("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE: int = int(os.environ.get("HTTP_MAX_KEEPALIVE", 20))
+HTTP_KEEPALIVE_EXPIRY: float = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 30))
+HTTP_TIMEOUT: float = float(os.environ.get("HTTP_TIMEOUT", 60))
+
+# Embedding requests are batched by item count and estimated token budget
+EMBEDDING_BATCH_SIZE: int = int(os.environ.get("EMBEDDING_BATCH_SIZE", 512))
+EMBEDDING_BATCH_TOKENS: int = int(os.environ.get("EMBEDDING_BATCH_TOKENS", 100_000))
+EMBEDDING_CONCURRENCY: int = int(os.environ.get("EMBEDDING_CONCURRENCY", 4))
+
+# Worker threads for blocking tool functions (file I/O, CPU work)
+TOOL_THREADS: int = int(os.environ.get("TOOL_THREADS", 200))
+
+# Local caches (routing decisions etc.) live next to the data by default
+CACHE_DIR: str = os.environ.get("CACHE_DIR", os.path.join(DATA_DIR, ".cache"))
+
+# Routing cache for aroute_task
+ROUTING_CACHE_SIZE: int = int(os.environ.get("ROUTING_CACHE_SIZE", 1024))
+ROUTING_CACHE_TTL: float = float(os.environ.get("ROUTING_CACHE_TTL", 7 * 24 * 3600))
+ROUTING_CACHE_PATH: str = os.environ.get(
+    "ROUTING_CACHE_PATH", os.path.join(CACHE_DIR, "routing-cache.db")
+)
+
+# Content-addressed embedding store (SQLite index + memory-mapped float32 vectors)
+EMBEDDING_STORE_DIR: str = os.environ.get(
+    "EMBEDDING_STORE_DIR", os.path.join(CACHE_DIR, "embeddings")
+)
+EMBEDDING_STORE_MAX_ROWS: int = int(os.environ.get("EMBEDDING_STORE_MAX_ROWS", 1_000_000))
+
+# Memory cap for one block of the all-pairs similarity matrix
+SIMILARITY_MEMORY_MB: int = int(os.environ.get("SIMILARITY_MEMORY_MB", 256))
+
+# Approximate (random-projection LSH) similarity search: more tables raise
+# recall, more bits per table shrink buckets and raise speed
+ANN_TABLES: int = int(os.environ.get("ANN_TABLES", 8))
+ANN_BITS: int = int(os.environ.get("ANN_BITS", 12))
+ANN_SEED: int = int(os.environ.get("ANN_SEED", 0))
+
+# Sharded line scanning over memory-mapped files, for large inputs only
+SCAN_WORKERS: int = int(os.environ.get("SCAN_WORKERS", os.cpu_count() or 1))
+SCAN_PARALLEL_BYTES: int = int(os.environ.get("SCAN_PARALLEL_BYTES", 16 << 20))
+
+# Shared thread pool for concurrent small file reads
+IO_THREADS: int = int(os.environ.get("IO_THREADS", 32))
+
+# Only this many bytes are read when looking for a log file's first line
+LOG_LINE_MAX_BYTES: int = int(os.environ.get("LOG_LINE_MAX_BYTES", 64 << 10))
+
+# Markdown files are read in chunks of this size, stopping at the first H1
+MARKDOWN_READ_CHUNK: int = int(os.environ.get("MARKDOWN_READ_CHUNK", 8 << 10))
+
+# Seconds between rescans of a watched docs tree
+MARKDOWN_WATCH_INTERVAL: float = float(os.environ.get("MARKDOWN_WATCH_INTERVAL", 2))
+
+# Persistent, incrementally refreshed index of log directories
+LOG_INDEX: bool = os.environ.get("LOG_INDEX", "").lower() in ("1", "true", "yes")
+LOG_INDEX_DIR: str = os.environ.get("LOG_INDEX_DIR", os.path.join(CACHE_DIR, "logs"))
+LOG_INDEX_FULL_REFRESH: float = float(os.environ.get("LOG_INDEX_FULL_REFRESH", 60))
+
+# Contacts larger than this are sorted out of core in runs of CONTACTS_RUN_SIZE
+CONTACTS_STREAM_BYTES: int = int(os.environ.get("CONTACTS_STREAM_BYTES", 256 << 20))
+CONTACTS_RUN_SIZE: int = int(os.environ.get("CONTACTS_RUN_SIZE", 100_000))
+# At least two runs per merge, or the merge passes never shrink the run count
+CONTACTS_MERGE_FAN_IN: int = max(2, int(os.environ.get("CONTACTS_MERGE_FAN_IN", 128)))
+
+# Warm EasyOCR readers shared across requests
+OCR_POOL_SIZE: int = int(os.environ.get("OCR_POOL_SIZE", 1))
+OCR_PRELOAD: bool = os.environ.get("OCR_PRELOAD", "").lower() in ("1", "true", "yes")
+OCR_QUEUE_TIMEOUT: float = float(os.environ.get("OCR_QUEUE_TIMEOUT", 300))
+
+# EasyOCR only sees the text band most likely to hold the card number,
+# downscaled to at most this many pixels high
+OCR_ROI_MAX_HEIGHT: int = int(os.environ.get("OCR_ROI_MAX_HEIGHT", 64))
+
+# Bulk OCR worker processes, each holding its own warm reader
+OCR_BULK_WORKERS: int = int(os.environ.get("OCR_BULK_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Torch-free template matcher tried before EasyOCR; minimum per-digit score
+OCR_TEMPLATE_MIN_SCORE: float = float(os.environ.get("OCR_TEMPLATE_MIN_SCORE", 0.85))
+
+# Long-lived Node prettier workers used by format_file before falling back to npx
+PRETTIER_WORKERS: int = int(os.environ.get("PRETTIER_WORKERS", 2))
+PRETTIER_TIMEOUT: float = float(os.environ.get("PRETTIER_TIMEOUT", 30))
+PRETTIER_RETRY_SECONDS: float = float(os.environ.get("PRETTIER_RETRY_SECONDS", 60))
+PRETTIER_WORKER_SCRIPT: str = os.environ.get(
+    "PRETTIER_WORKER_SCRIPT",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "prettier_worker.js"),
+)
+
+# Contents known to be formatted already, and files per npx run in batch mode
+FORMAT_CACHE_PATH: str = os.environ.get("FORMAT_CACHE_PATH", os.path.join(CACHE_DIR, "formatted.db"))
+FORMAT_CACHE_SIZE: int = int(os.environ.get("FORMAT_CACHE_SIZE", 100_000))
+FORMAT_CLI_BATCH: int = int(os.environ.get("FORMAT_CLI_BATCH", 200))
+
+# Memoized date strings and per-file weekday histograms for count_weekday
+DATE_CACHE_SIZE: int = int(os.environ.get("DATE_CACHE_SIZE", 1 << 16))
+WEEKDAY_CACHE_DIR: str = os.environ.get("WEEKDAY_CACHE_DIR", os.path.join(CACHE_DIR, "weekdays"))
+
+# Pooled read-only SQLite connections and their cached query results
+SQLITE_POOL_SIZE: int = int(os.environ.get("SQLITE_POOL_SIZE", 4))
+SQLITE_CACHE_KIB: int = int(os.environ.get("SQLITE_CACHE_KIB", 64 << 10))
+SQLITE_MMAP_BYTES: int = int(os.environ.get("SQLITE_MMAP_BYTES", 256 << 20))
+SQLITE_RESULT_CACHE_SIZE: int = int(os.environ.get("SQLITE_RESULT_CACHE_SIZE", 256))
+SQLITE_ACQUIRE_TIMEOUT: float = float(os.environ.get("SQLITE_ACQUIRE_TIMEOUT", 30))
+# Opt-in: indexes are created on the queried database itself, one per column
+# set and collation that queries filter on
+SQLITE_AUTO_INDEX: bool = os.environ.get("SQLITE_AUTO_INDEX", "").lower() in ("1", "true", "yes")
+
+# Rows fetched per batch when streaming query results to a file
+SQLITE_EXPORT_BATCH: int = int(os.environ.get("SQLITE_EXPORT_BATCH", 5000))
+
+# Answer ticket sales from the trigger-maintained ticket_totals table when installed
+TICKET_TOTALS: bool = os.environ.get("TICKET_TOTALS", "").lower() in ("1", "true", "yes")
+
+
 @app.post("/run")
-def run_task(task: str):
+async def run_task(task: str):
     if not task:
         raise HTTPException(status_code=400, detail="Task description is required")
 
     try:
-        tool = get_task_tool(task, task_tools)
-        return execute_tool_calls(tool)
+        tool = await aroute_task(task, task_tools)
+        # Tool functions do blocking file and CPU work, keep them off the event loop
+        return await run_in_threadpool(execute_tool_calls, tool)
 
     except Exception as e:
         detail: str = e.detail if hasattr(e, "detail") else str(e)
@@ -84,8 +237,8 @@ def execute_tool_calls(tool: Dict[str, Any]) -> Any:
             function_name = tool_call["function"].get("name")
             function_args = tool_call["function"].get("arguments")
 
-            # Ensure the function name is valid and callable
-            if function_name in globals() and callable(globals()[function_name]):
+            # Ensure the function name is a declared tool, not any module global
+            if function_name in task_tool_names and callable(globals().get(function_name)):
                 function_chosen = globals()[function_name]
                 function_args = parse_function_args(function_args)
 
@@ -108,6 +261,11 @@ def parse_function_args(function_args: Optional[Any]) -> Dict[str, Any]:
     return function_args
 
 
+@app.get("/routing-cache")
+def routing_cache_stats() -> Dict[str, Any]:
+    return {**routing_cache.stats(), "pre_router": dict(pre_router_stats)}
+
+
 @app.get("/read")
 def read_file(path: str) -> Response:
     if not path:
@@ -133,14 +291,19 @@ task_tools = [
         "type": "function",
         "function": {
             "name": "format_file",
-            "description": "Format a file using prettier",
+            "description": "Format a file, or every file in a directory or glob, using prettier",
             "parameters": {
                 "type": "object",
                 "properties": {
                     "source": {
                         "type": "string",
-                        "description": "File path to format.",
-                    }
+                        "description": "File path, directory or glob pattern of the files to format.",
+                    },
+                    "pattern": {
+                        "type": ["string", "null"],
+                        "description": "Glob of files to format inside a directory source. If unavailable, set to null.",
+                        "nullable": True,
+                    },
                 },
                 "required": ["source"],
                 "additionalProperties": False,
@@ -170,6 +333,10 @@ task_tools = [
                         "description": "Path to the destination file. If unavailable, set to null.",
                         "nullable": True,
                     },
+                    "histogram": {
+                        "type": "boolean",
+                        "description": "Also return the count for every weekday.",
+                    },
                 },
                 "required": ["weekday", "source", "destination"],
                 "additionalProperties": False,
@@ -201,13 +368,73 @@ task_tools = [
                         "description": "Path to the destination file. If unavailable, set to null.",
                         "nullable": True,
                     },
+                    "streaming": {
+                        "type": ["boolean", "null"],
+                        "description": "Sort on disk with bounded memory (true) or in memory (false). Set to null to decide by file size.",
+                        "nullable": True,
+                    },
+                    "index": {
+                        "type": ["boolean", "null"],
+                        "description": "Also build a persistent name index of the sorted file for later lookups. If unavailable, set to null.",
+                        "nullable": True,
+                    },
                 },
-                "required": ["order", "source", "destination"],
+                "required": ["order", "source", "destination", "streaming", "index"],
                 "additionalProperties": False,
             },
             "strict": True,
         },
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "lookup_contacts",
+            "description": "Look up contacts in a JSON file by name prefix or name range, using a persistent name index",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "source": {
+                        "type": ["string", "null"],
+                        "description": "Path to the contacts JSON file. If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                    "prefix": {
+                        "type": ["string", "null"],
+                        "description": "Name prefix to match (case-insensitive). If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                    "start": {
+                        "type": ["string", "null"],
+                        "description": "Inclusive lower bound of the name range. If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                    "end": {
+                        "type": ["string", "null"],
+                        "description": "Exclusive upper bound of the name range. If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                    "field": {
+                        "type": "string",
+                        "description": "Name field to search",
+                        "enum": ["last_name", "first_name"],
+                        "default": "last_name",
+                    },
+                    "limit": {
+                        "type": "integer",
+                        "description": "Maximum number of contacts to return",
+                    },
+                    "destination": {
+                        "type": ["string", "null"],
+                        "description": "Path to the destination file. If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                },
+                "required": ["source", "prefix", "start", "end", "field", "destination"],
+                "additionalProperties": False,
+            },
+            # "strict": True,
+        },
+    },
     {
         "type": "function",
         "function": {
@@ -230,6 +457,10 @@ task_tools = [
                         "description": "Path to the destination file. If unavailable, set to null.",
                         "nullable": True,
                     },
+                    "recursive": {
+                        "type": "boolean",
+                        "description": "Also include log files in nested directories.",
+                    },
                 },
                 "required": ["count", "source", "destination"],
                 "additionalProperties": False,
@@ -255,6 +486,10 @@ task_tools = [
                         "description": "Path to the destination file. If unavailable, set to null.",
                         "nullable": True,
                     },
+                    "watch": {
+                        "type": "boolean",
+                        "description": "Keep the index up to date as Markdown files change.",
+                    },
                 },
                 "required": ["source", "destination"],
                 "additionalProperties": False,
@@ -312,6 +547,31 @@ task_tools = [
             # "strict": True,
         },
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "extract_credit_card_numbers",
+            "description": "Extract the credit card numbers from many images (a directory, glob or list of image files) into a JSON Lines file",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "source": {
+                        "type": ["string", "array"],
+                        "items": {"type": "string"},
+                        "description": "Directory, glob pattern or list of image paths.",
+                    },
+                    "destination": {
+                        "type": ["string", "null"],
+                        "description": "Path to the JSON Lines output file. If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                },
+                "required": ["source", "destination"],
+                "additionalProperties": False,
+            },
+            # "strict": True,
+        },
+    },
     {
         "type": "function",
         "function": {
@@ -320,6 +580,16 @@ task_tools = [
             "parameters": {
                 "type": "object",
                 "properties": {
+                    "top_k": {
+                        "type": "integer",
+                        "description": "Number of most similar pairs to report. Defaults to 1.",
+                    },
+                    "mode": {
+                        "type": "string",
+                        "description": "Search mode: exact, or ann (approximate) for very large files.",
+                        "enum": ["exact", "ann"],
+                        "default": "exact",
+                    },
                     "source": {
                         "type": ["string", "null"],
                         "description": "Path to the source file. If unavailable, set to null.",
@@ -337,531 +607,4045 @@ task_tools = [
             # "strict": True,
         },
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "calculate_ticket_sales",
+            "description": "Calculate the total sales (units * price) of a ticket type in the SQLite tickets database",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "ticket_type": {
+                        "type": "string",
+                        "description": "Ticket type to total, e.g. Gold, Silver or Bronze.",
+                    },
+                    "source": {
+                        "type": ["string", "null"],
+                        "description": "Path to the SQLite database. If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                    "destination": {
+                        "type": ["string", "null"],
+                        "description": "Path to the destination file. If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                },
+                "required": ["ticket_type", "source", "destination"],
+                "additionalProperties": False,
+            },
+            # "strict": True,
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "query_database",
+            "description": "Run a read-only SQL aggregation query (SELECT) against a SQLite database and write the result",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "A single SELECT statement. Use ? placeholders for values.",
+                    },
+                    "params": {
+                        "type": ["array", "null"],
+                        "items": {"type": ["string", "number"]},
+                        "description": "Values for the ? placeholders, in order. If none, set to null.",
+                        "nullable": True,
+                    },
+                    "source": {
+                        "type": ["string", "null"],
+                        "description": "Path to the SQLite database. If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                    "destination": {
+                        "type": ["string", "null"],
+                        "description": "Path to the destination file. If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                },
+                "required": ["query", "params", "source", "destination"],
+                "additionalProperties": False,
+            },
+            # "strict": True,
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "export_query",
+            "description": "Export the rows of a read-only SQL query (SELECT) on a SQLite database to a CSV, JSON Lines or JSON file",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "A single SELECT statement. Use ? placeholders for values.",
+                    },
+                    "params": {
+                        "type": ["array", "null"],
+                        "items": {"type": ["string", "number"]},
+                        "description": "Values for the ? placeholders, in order. If none, set to null.",
+                        "nullable": True,
+                    },
+                    "source": {
+                        "type": ["string", "null"],
+                        "description": "Path to the SQLite database. If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                    "destination": {
+                        "type": ["string", "null"],
+                        "description": "Path to the destination file. If unavailable, set to null.",
+                        "nullable": True,
+                    },
+                    "format": {
+                        "type": ["string", "null"],
+                        "description": "Output format. If null, taken from the destination extension.",
+                        "enum": ["csv", "jsonl", "json", None],
+                        "nullable": True,
+                    },
+                    "limit": {
+                        "type": ["integer", "null"],
+                        "description": "Maximum number of rows to export. If unlimited, set to null.",
+                        "nullable": True,
+                    },
+                },
+                "required": ["query", "params", "source", "destination"],
+                "additionalProperties": False,
+            },
+            # "strict": True,
+        },
+    },
 ]
 
+# Only these functions may be dispatched from a model's tool calls
+task_tool_names = frozenset(tool["function"]["name"] for tool in task_tools)
 
-def get_task_tool(task: str, tools: list[Dict[str, Any]]) -> Dict[str, Any]:
-    response = httpx.post(
-        f"{AI_URL}/chat/completions",
-        headers={
-            "Authorization": f"Bearer {AIPROXY_TOKEN}:{APP_ID}",
-            "Content-Type": "application/json",
-        },
-        json={
-            "model": AI_MODEL,
-            "messages": [{"role": "user", "content": task}],
-            "tools": tools,
-            "tool_choice": "auto",
-        },
-    )
 
-    json_response = response.json()
+http_client: Optional[httpx.AsyncClient] = None
+http_client_loop: Optional[asyncio.AbstractEventLoop] = None
 
-    if "error" in json_response:
-        raise HTTPException(status_code=500, detail=json_response["error"]["message"])
 
-    return json_response["choices"][0]["message"]
+def create_http_client() -> httpx.AsyncClient:
+    # HTTP/2 needs the optional "h2" package
+    try:
+        import h2  # noqa: F401
 
+        http2 = True
 
-def get_chat_completions(messages: list[Dict[str, Any]]) -> Dict[str, Any]:
-    response = httpx.post(
-        f"{AI_URL}/chat/completions",
+    except ImportError:
+        http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=HTTP_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
         headers={
             "Authorization": f"Bearer {AIPROXY_TOKEN}:{APP_ID}",
             "Content-Type": "application/json",
         },
-        json={
-            "model": AI_MODEL,
-            "messages": messages,
-        },
     )
 
-    # response.raise_for_status()
 
-    json_response = response.json()
+async def start_http_client():
+    global http_client, http_client_loop
 
-    if "error" in json_response:
-        raise HTTPException(status_code=500, detail=json_response["error"]["message"])
+    http_client = create_http_client()
+    http_client_loop = asyncio.get_running_loop()
+    anyio.to_thread.current_default_thread_limiter().total_tokens = TOOL_THREADS
 
-    return json_response["choices"][0]["message"]
 
+async def stop_http_client():
+    global http_client, http_client_loop
 
-def get_embeddings(text: str) -> Dict[str, Any]:
-    response = httpx.post(
-        f"{AI_URL}/embeddings",
-        headers={
-            "Authorization": f"Bearer {AIPROXY_TOKEN}:{APP_ID}",
-            "Content-Type": "application/json",
-        },
-        json={
-            "model": AI_EMBEDDINGS_MODEL,
-            "input": text,
-        },
-    )
+    if http_client is not None:
+        await http_client.aclose()
 
-    # response.raise_for_status()
+    http_client = None
+    http_client_loop = None
 
-    json_response = response.json()
 
-    if "error" in json_response:
-        raise HTTPException(status_code=500, detail=json_response["error"]["message"])
+async def ai_post(
+    path: str, payload: Dict[str, Any], client: Optional[httpx.AsyncClient] = None
+) -> Dict[str, Any]:
+    client = client or http_client
 
-    return json_response["data"][0]["embedding"]
+    if client is None:
+        async with create_http_client() as client:
+            return await ai_post(path, payload, client)
 
+    response = await client.post(f"{AI_URL}{path}", json=payload)
 
-def file_rename(name: str, suffix: str) -> str:
-    return (re.sub(r"\.(\w+)$", "", name) + suffix).lower()
+    # response.raise_for_status()
 
+    json_response = response.json()
 
-# A1. Data initialization
-def initialize_data():
-    logging.info(f"DATA - {DATA_DIR}")
-    logging.info(f"USER - {DEV_EMAIL}")
+    if "error" in json_response:
+        raise HTTPException(status_code=500, detail=json_response["error"]["message"])
 
-    try:
-        # Ensure the 'uv' package is installed
-        try:
-            import uv
+    return json_response
 
-        except ImportError:
-            logging.info("'uv' package not found. Installing...")
 
-            subprocess.check_call([sys.executable, "-m", "ensurepip", "--upgrade"])
+def run_ai_sync(coroutine_function, *args):
+    """Run an AI proxy coroutine from synchronous tool code.
 
-            subprocess.check_call(
-                [sys.executable, "-m", "pip", "install", "--upgrade", "uv"]
-            )
+    Tool functions run in the threadpool, so while the app is up the call is
+    scheduled on its event loop and shares the pooled client. Outside the app
+    (scripts, worker processes) a short-lived loop and client are used.
+    """
+    try:
+        running_loop = asyncio.get_running_loop()
 
-            import uv
+    except RuntimeError:
+        running_loop = None
 
-        # Run the data generation script
-        result = subprocess.run(
-            [
-                "uv",
-                "run",
-                "https://raw.githubusercontent.com/sanand0/tools-in-data-science-public/tds-2025-01/project-1/datagen.py",
-                f"--root={DATA_DIR}",
-                DEV_EMAIL,
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
+    # Blocking on a running loop (the app's or any other) would deadlock it
+    if running_loop is not None:
+        raise RuntimeError(
+            f"{coroutine_function.__name__} must be awaited on the event loop; "
+            "run_ai_sync is for synchronous tool code running in the threadpool"
         )
 
-        if result.returncode == 0:
-            logging.info("Data initialization completed successfully.")
+    loop = http_client_loop
 
-        else:
-            logging.error(
-                f"Data initialization failed with return code {result.returncode}"
-            )
-            logging.error(f"Error output: {result.stderr}")
+    if http_client is not None and loop is not None and loop.is_running():
+        future = asyncio.run_coroutine_threadsafe(coroutine_function(*args), loop)
+        return future.result()
 
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Subprocess error: {e}")
-        logging.error(f"Output: {e.output}")
+    async def run_standalone():
+        async with create_http_client() as client:
+            return await coroutine_function(*args, client=client)
 
-    except Exception as e:
-        logging.error(f"Error in initializing data: {e}")
+    return asyncio.run(run_standalone())
 
 
-# A2. Format a file using prettier
-import os
-import subprocess
+async def aget_task_tool(
+    task: str, tools: list[Dict[str, Any]], client: Optional[httpx.AsyncClient] = None
+) -> Dict[str, Any]:
+    json_response = await ai_post(
+        "/chat/completions",
+        {
+            "model": AI_MODEL,
+            "messages": [{"role": "user", "content": task}],
+            "tools": tools,
+            "tool_choice": "auto",
+        },
+        client,
+    )
+
+    return json_response["choices"][0]["message"]
+
+
+# Routing cache: the same task phrasings map to the same tool calls, so we
+# remember the LLM's answer in an in-memory LRU backed by SQLite on disk.
+def normalize_task(task: str) -> str:
+    return re.sub(r"\s+", " ", task).strip().lower()
+
+
+def task_cache_text(task: str) -> str:
+    """Whitespace-collapsed task, lowercased except for file paths, which are
+    case-sensitive and end up in the cached tool arguments."""
+    parts = route_path_pattern.split(re.sub(r"\s+", " ", task).strip())
+    return "".join(part if n % 2 else part.lower() for n, part in enumerate(parts))
+
+
+def tools_fingerprint(tools: list[Dict[str, Any]]) -> str:
+    return hashlib.sha256(json.dumps(tools, sort_keys=True).encode()).hexdigest()
+
+
+class RoutingCache:
+    def __init__(self, path: str, max_size: int, ttl: float):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries: "OrderedDict[str, tuple[float, list]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS routes "
+                "(key TEXT PRIMARY KEY, tool_calls TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS routes_created ON routes (created)"
+            )
+            self.conn.commit()
+
+        except sqlite3.Error as e:
+            logging.error(f"Routing cache disabled on disk ({path}): {e}")
+            self.conn = None
+
+    @staticmethod
+    def make_key(task: str, tools: list[Dict[str, Any]]) -> str:
+        return hashlib.sha256(
+            f"{tools_fingerprint(tools)}:{task_cache_text(task)}".encode()
+        ).hexdigest()
+
+    def get(self, task: str, tools: list[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        key = self.make_key(task, tools)
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None and self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT created, tool_calls FROM routes WHERE key = ?", (key,)
+                ).fetchone()
+                if row:
+                    entry = (row[0], json.loads(row[1]))
+
+            if entry is None or now - entry[0] > self.ttl:
+                if entry is not None:
+                    self._delete(key)
+                self.misses += 1
+                return None
+
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self._trim_memory()
+            self.hits += 1
+
+            return {"tool_calls": entry[1]}
+
+    def put(self, task: str, tools: list[Dict[str, Any]], tool: Dict[str, Any]):
+        tool_calls = [
+            {
+                "type": "function",
+                "function": {
+                    "name": tool_call["function"].get("name"),
+                    "arguments": tool_call["function"].get("arguments"),
+                },
+            }
+            for tool_call in tool.get("tool_calls") or []
+        ]
+
+        # Only remember answers that actually picked a tool
+        if not tool_calls:
+            return
+
+        key = self.make_key(task, tools)
+        entry = (time.time(), tool_calls)
+
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self._trim_memory()
+
+            if self.conn is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO routes (key, tool_calls, created) VALUES (?, ?, ?)",
+                    (key, json.dumps(tool_calls), entry[0]),
+                )
+                self.conn.execute(
+                    "DELETE FROM routes WHERE created < ?", (entry[0] - self.ttl,)
+                )
+                self.conn.execute(
+                    "DELETE FROM routes WHERE key IN "
+                    "(SELECT key FROM routes ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.max_size,),
+                )
+                self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM routes")
+                self.conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stored = (
+                self.conn.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+                if self.conn is not None
+                else None
+            )
+            lookups = self.hits + self.misses
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self.entries),
+                "disk_entries": stored,
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+            }
+
+    def _delete(self, key: str):
+        self.entries.pop(key, None)
+        if self.conn is not None:
+            self.conn.execute("DELETE FROM routes WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def _trim_memory(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+routing_cache = RoutingCache(ROUTING_CACHE_PATH, ROUTING_CACHE_SIZE, ROUTING_CACHE_TTL)
+
+
+# Offline pre-router: the common A1-A10 phrasings are recognised locally with
+# regex templates plus keyword overlap against the tool descriptions, so the
+# LLM is only consulted when the match is ambiguous.
+route_templates: Dict[str, list] = {
+    "format_file": [re.compile(r"\bprettier\b|\bformat(?:ting)? (?:the )?(?:contents|file)\b")],
+    "count_weekday": [
+        re.compile(
+            r"\b(?:count|number of|how many)\b.*?\b(mon|tues|wednes|thurs|fri|satur|sun)days?\b"
+        )
+    ],
+    "sort_contacts": [re.compile(r"\bsort\b.*\bcontacts?\b")],
+    "write_recent_logs": [re.compile(r"\brecent\b.*\.log\b|\.log\b.*\brecent\b")],
+    "extract_markdown_titles": [
+        re.compile(r"(?:\bmarkdown\b|\.md\b).*\b(?:titles?|h1|index)\b")
+    ],
+    "extract_email_sender": [re.compile(r"\bsender'?s?\b.*\bemail\b|\bemail\b.*\bsender\b")],
+    "extract_credit_card_number": [re.compile(r"\bcredit[\s_-]?card\b|\bcard number\b")],
+    "extract_credit_card_numbers": [
+        re.compile(r"\bcard (?:numbers|images)\b|\b(?:all|many|every)\b.*\bimages?\b")
+    ],
+    "similar_comments": [re.compile(r"\bsimilar\b.*\bcomments?\b|\bcomments?\b.*\bsimilar\b")],
+    "calculate_ticket_sales": [
+        re.compile(r"\btickets?\b.*\bsales\b.*\b(?:gold|silver|bronze)\b|\btotal sales\b.*\bticket type\b")
+    ],
+}
+
+route_stopwords = {
+    "the", "and", "from", "file", "files", "directory", "provided", "their",
+    "using", "data", "most", "first", "specific", "with", "into", "each",
+}
+
+route_path_pattern = re.compile(r"(?<![\w.@])(/[\w.\-/]+|[A-Za-z]:[\\/][\w.\-\\/]+)")
+
+route_negation_pattern = re.compile(
+    r"\b(?:don'?t|do not|doesn'?t|does not|not|never|no|without|instead of|rather than|skip)\b"
+)
+
+# A template match alone scores 0.7: at least one description keyword must
+# also appear in the task before the LLM is skipped
+PRE_ROUTER_MIN_CONFIDENCE: float = float(os.environ.get("PRE_ROUTER_MIN_CONFIDENCE", 0.75))
+
+pre_router_stats: Dict[str, int] = {"hits": 0, "misses": 0}
+
+
+def route_tokens(text: str) -> set:
+    return {
+        word
+        for word in re.findall(r"[a-z]+", text.lower())
+        if len(word) > 2 and word not in route_stopwords
+    }
+
+
+def route_negated(text: str, position: int) -> bool:
+    """Whether the clause leading up to `position` negates it ("don't count ...")."""
+    clause = re.split(r"[.;:!?\n]", text[:position])[-1]
+    return bool(route_negation_pattern.search(clause))
+
+
+def score_task_tools(task: str, tools: list[Dict[str, Any]]) -> list[tuple[float, str]]:
+    text = normalize_task(task)
+    task_words = route_tokens(text)
+    scores = []
+
+    for tool in tools:
+        name = tool["function"]["name"]
+        keywords = route_tokens(tool["function"].get("description", ""))
+        overlap = len(task_words & keywords) / min(len(keywords), 4) if keywords else 0.0
+        matched = any(
+            not route_negated(text, match.start())
+            for t in route_templates.get(name, [])
+            for match in t.finditer(text)
+        )
+        scores.append((0.7 * matched + 0.3 * min(overlap, 1.0), name))
+
+    return sorted(scores, reverse=True)
+
+
+def extract_route_arguments(name: str, task: str) -> Dict[str, Any]:
+    text = normalize_task(task)
+    # Unique paths in order of first mention: source first, destination last
+    paths = list(dict.fromkeys(p.rstrip(".,;:") for p in route_path_pattern.findall(task)))
+    args: Dict[str, Any] = {
+        "source": paths[0] if paths else None,
+        "destination": paths[-1] if len(paths) > 1 else None,
+    }
+
+    if name == "format_file":
+        args.pop("destination")
+
+    elif name == "count_weekday":
+        match = route_templates[name][0].search(text)
+        args["weekday"] = normalize_weekday(match.group(1)[:3]) if match else None
+
+    elif name == "sort_contacts":
+        first = re.search(r"first[_ ]name", text)
+        last = re.search(r"last[_ ]name", text)
+        args["order"] = (
+            "first_name" if first and (not last or first.start() < last.start()) else "last_name"
+        )
+        args["index"] = bool(re.search(r"\b(?:index|lookups?)\b", text))
+
+    elif name == "write_recent_logs":
+        match = re.search(r"\b(\d+)\b(?:\s+\w+){0,2}\s+recent|recent\s+(\d+)\b", text)
+        args["count"] = int(match.group(1) or match.group(2)) if match else 10
+
+    elif name == "calculate_ticket_sales":
+        match = re.search(r"\b(gold|silver|bronze)\b", text)
+        args["ticket_type"] = match.group(1).title() if match else None
+
+    return args
+
+
+def pre_route_task(task: str, tools: list[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    scores = score_task_tools(task, tools)
+    if not scores:
+        return None
+
+    confidence, name = scores[0]
+
+    # Penalise near ties between the top two candidates
+    if len(scores) > 1 and scores[1][0] > confidence - 0.15:
+        confidence /= 2
+
+    args = extract_route_arguments(name, task)
+    tool = next(t for t in tools if t["function"]["name"] == name)
+
+    # Strict schemas list every parameter as required; nullable ones may stay null
+    properties = tool["function"]["parameters"].get("properties", {})
+    for param in tool["function"]["parameters"].get("required", []):
+        if args.get(param) is None and not properties.get(param, {}).get("nullable"):
+            confidence = 0.0
+
+    if confidence < PRE_ROUTER_MIN_CONFIDENCE:
+        pre_router_stats["misses"] += 1
+        return None
+
+    pre_router_stats["hits"] += 1
+
+    return {
+        "tool_calls": [
+            {
+                "id": "pre-router",
+                "type": "function",
+                "function": {"name": name, "arguments": json.dumps(args)},
+            }
+        ],
+        "confidence": confidence,
+    }
+
+
+async def aroute_task(task: str, tools: list[Dict[str, Any]]) -> Dict[str, Any]:
+    tool = pre_route_task(task, tools)
+    if tool is not None:
+        return tool
+
+    tool = await run_in_threadpool(routing_cache.get, task, tools)
+
+    if tool is None:
+        tool = await aget_task_tool(task, tools)
+        await run_in_threadpool(routing_cache.put, task, tools, tool)
+
+    return tool
+
+
+async def aget_chat_completions(
+    messages: list[Dict[str, Any]], client: Optional[httpx.AsyncClient] = None
+) -> Dict[str, Any]:
+    json_response = await ai_post(
+        "/chat/completions",
+        {
+            "model": AI_MODEL,
+            "messages": messages,
+        },
+        client,
+    )
+
+    return json_response["choices"][0]["message"]
+
+
+def get_chat_completions(messages: list[Dict[str, Any]]) -> Dict[str, Any]:
+    return run_ai_sync(aget_chat_completions, messages)
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English text
+    return len(text) // 4 + 1
+
+
+def chunk_embedding_inputs(texts: list[str]) -> list[list[int]]:
+    chunks: list[list[int]] = []
+    chunk: list[int] = []
+    tokens = 0
+
+    for i, text in enumerate(texts):
+        text_tokens = estimate_tokens(text)
+
+        if chunk and (
+            len(chunk) >= EMBEDDING_BATCH_SIZE or tokens + text_tokens > EMBEDDING_BATCH_TOKENS
+        ):
+            chunks.append(chunk)
+            chunk, tokens = [], 0
+
+        chunk.append(i)
+        tokens += text_tokens
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+async def aget_embeddings_batch(
+    texts: list[str], client: Optional[httpx.AsyncClient] = None
+) -> list[list[float]]:
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+    embeddings: list[Optional[list[float]]] = [None] * len(texts)
+
+    async def embed_chunk(indices: list[int]):
+        async with semaphore:
+            json_response = await ai_post(
+                "/embeddings",
+                {
+                    "model": AI_EMBEDDINGS_MODEL,
+                    "input": [texts[i] for i in indices],
+                },
+                client,
+            )
+
+        # "index" is the position within this chunk's input
+        for item in json_response["data"]:
+            embeddings[indices[item["index"]]] = item["embedding"]
+
+    await asyncio.gather(*(embed_chunk(c) for c in chunk_embedding_inputs(texts)))
+
+    return embeddings
+
+
+async def aget_embeddings(
+    text: Union[str, list[str]], client: Optional[httpx.AsyncClient] = None
+) -> Union[list[float], list[list[float]]]:
+    if isinstance(text, str):
+        return (await aget_embeddings_batch([text], client))[0]
+
+    return await aget_embeddings_batch(list(text), client)
+
+
+def get_embeddings(text: Union[str, list[str]]) -> Union[list[float], list[list[float]]]:
+    return run_ai_sync(aget_embeddings, text)
+
+
+def file_rename(name: str, suffix: str) -> str:
+    return (re.sub(r"\.(\w+)$", "", name) + suffix).lower()
+
+
+io_pool = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="io")
+
+
+# Sharded line scanner: a file is memory-mapped and split into byte ranges
+# that end on newlines; each range is handled by a worker process and the
+# partial results are merged by the caller.
+process_pool: Optional[ProcessPoolExecutor] = None
+process_pool_lock = threading.Lock()
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global process_pool
+
+    with process_pool_lock:
+        if process_pool is None:
+            # spawn, because forking a threaded server process is unsafe
+            process_pool = ProcessPoolExecutor(
+                max_workers=SCAN_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+
+        return process_pool
+
+
+def reset_process_pool(pool: ProcessPoolExecutor):
+    """Drop a pool broken by a dead worker; the next call starts a fresh one."""
+    global process_pool
+
+    with process_pool_lock:
+        if process_pool is pool:
+            process_pool = None
+
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_process_pool():
+    global process_pool
+
+    with process_pool_lock:
+        if process_pool is not None:
+            process_pool.shutdown(cancel_futures=True)
+            process_pool = None
+
+
+def split_line_ranges(path: str, shards: int) -> list[tuple[int, int]]:
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+
+    bounds = [0]
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for n in range(1, shards):
+            newline = mm.find(b"\n", max(size * n // shards, bounds[-1]))
+            if newline == -1 or newline + 1 >= size:
+                break
+            bounds.append(newline + 1)
+
+    bounds.append(size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_line_range(mm: mmap.mmap, start: int, end: int):
+    """Yield (start, end) byte offsets of each line in [start, end), without
+    the newline."""
+    pos = start
+
+    while pos < end:
+        newline = mm.find(b"\n", pos, end)
+        if newline == -1:
+            newline = end
+
+        yield pos, newline
+        pos = newline + 1
+
+
+def scan_lines(path: str, shard_function, *args) -> list:
+    """Run shard_function(path, start, end, *args) over newline-aligned
+    shards of path and return the partial results in file order. Small
+    files are scanned in-process."""
+    shards = SCAN_WORKERS if os.path.getsize(path) >= SCAN_PARALLEL_BYTES else 1
+    ranges = split_line_ranges(path, shards)
+
+    if len(ranges) <= 1:
+        return [shard_function(path, start, end, *args) for start, end in ranges]
+
+    # A dead worker (e.g. OOM-killed) breaks the whole pool: start a fresh one and retry once
+    for attempt in range(2):
+        pool = get_process_pool()
+
+        try:
+            futures = [pool.submit(shard_function, path, start, end, *args) for start, end in ranges]
+            return [future.result() for future in futures]
+
+        except BrokenProcessPool:
+            reset_process_pool(pool)
+            if attempt:
+                raise
+
+            logging.warning(f"Scan worker crashed while reading {path}, retrying")
+
+
+def line_offsets_shard(path: str, start: int, end: int) -> np.ndarray:
+    """(n, 2) array of start/end offsets of the non-blank lines in a shard."""
+    offsets = []
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line_start, line_end in iter_line_range(mm, start, end):
+            if mm[line_start:line_end].strip():
+                offsets.append((line_start, line_end))
+
+    return np.array(offsets, dtype=np.int64).reshape(-1, 2)
+
+
+def read_lines(path: str) -> list[str]:
+    """Non-blank, stripped lines of a text file, located by a sharded scan."""
+    offsets = scan_lines(path, line_offsets_shard)
+    if not offsets:
+        return []
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return [
+            mm[start:end].decode("utf-8").strip()
+            for start, end in np.concatenate(offsets).tolist()
+        ]
+
+
+# A1. Data initialization
+def initialize_data():
+    logging.info(f"DATA - {DATA_DIR}")
+    logging.info(f"USER - {DEV_EMAIL}")
+
+    try:
+        # Ensure the 'uv' package is installed
+        try:
+            import uv
+
+        except ImportError:
+            logging.info("'uv' package not found. Installing...")
+
+            subprocess.check_call([sys.executable, "-m", "ensurepip", "--upgrade"])
+
+            subprocess.check_call(
+                [sys.executable, "-m", "pip", "install", "--upgrade", "uv"]
+            )
+
+            import uv
+
+        # Run the data generation script
+        result = subprocess.run(
+            [
+                "uv",
+                "run",
+                "https://raw.githubusercontent.com/sanand0/tools-in-data-science-public/tds-2025-01/project-1/datagen.py",
+                f"--root={DATA_DIR}",
+                DEV_EMAIL,
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+
+        if result.returncode == 0:
+            logging.info("Data initialization completed successfully.")
+
+        else:
+            logging.error(
+                f"Data initialization failed with return code {result.returncode}"
+            )
+            logging.error(f"Error output: {result.stderr}")
+
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Subprocess error: {e}")
+        logging.error(f"Output: {e.output}")
+
+    except Exception as e:
+        logging.error(f"Error in initializing data: {e}")
+
+
+# A2. Format a file using prettier
+import os
+import subprocess
 from fastapi import HTTPException
 
-def format_file(source: str = None) -> dict:
+prettier_options: Dict[str, Any] = {
+    "parser": "markdown",
+    "proseWrap": "preserve",  # Prevents unwanted line breaks
+    "tabWidth": 2,
+    "useTabs": False,
+    "semi": False,  # Helps with bullet list issues
+}
+
+
+class PrettierWorker:
+    """A `node prettier_worker.js` process speaking one JSON object per line."""
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            ["node", PRETTIER_WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            encoding="utf-8",
+            bufsize=1,
+        )
+        # A reader thread keeps the timeouts portable (no select() on Windows pipes)
+        self.replies: queue.Queue = queue.Queue()
+        threading.Thread(target=self.read_replies, daemon=True).start()
+        self.requests = 0
+
+        try:
+            ready = self.receive()
+            if not ready.get("ready"):
+                raise RuntimeError(f"Prettier worker failed to start: {ready.get('error')}")
+
+        except BaseException:
+            self.close()
+            raise
+
+        self.version = ready.get("version")
+
+    def read_replies(self):
+        for line in self.process.stdout:
+            self.replies.put(line)
+        self.replies.put(None)
+
+    def receive(self) -> Dict[str, Any]:
+        try:
+            line = self.replies.get(timeout=PRETTIER_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError("Prettier worker timed out")
+
+        if line is None:
+            raise RuntimeError("Prettier worker exited")
+
+        return json.loads(line)
+
+    def call(self, **request) -> Dict[str, Any]:
+        self.requests += 1
+        self.process.stdin.write(json.dumps({"id": self.requests, **request}) + "\n")
+        self.process.stdin.flush()
+
+        reply = self.receive()
+        while reply.get("id") != self.requests:
+            reply = self.receive()
+
+        if not reply.get("ok"):
+            raise ValueError(reply.get("error"))
+
+        return reply
+
+    def format(self, text: str, options: Dict[str, Any], resolved: bool = False) -> str:
+        return self.call(text=text, options=options, resolved=resolved)["text"]
+
+    def resolve_config(self, file_path: str) -> Optional[Dict[str, Any]]:
+        return self.call(resolveConfig=file_path)["config"]
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+class PrettierPool:
+    """Up to `size` prettier workers, started on first use and handed out one
+    file at a time. A worker that crashes or hangs is discarded and replaced
+    on the next request; if workers cannot start at all (no node, no
+    prettier), the pool stays off for PRETTIER_RETRY_SECONDS."""
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self.workers: queue.Queue = queue.Queue()
+        self.running: set = set()
+        self.created = 0
+        self.restarts = 0
+        self.disabled_until = 0.0
+        self.version: Optional[str] = None
+        self.lock = threading.Lock()
+
+    def acquire(self) -> PrettierWorker:
+        if time.monotonic() < self.disabled_until:
+            raise RuntimeError("Prettier workers are unavailable")
+
+        try:
+            return self.workers.get_nowait()
+
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+
+        if create:
+            try:
+                worker = PrettierWorker()
+                with self.lock:
+                    self.running.add(worker)
+                self.version = worker.version
+                logging.info(f"Started prettier {worker.version} worker {self.created}/{self.size}")
+                return worker
+
+            except (OSError, RuntimeError, ValueError) as e:
+                with self.lock:
+                    self.created -= 1
+                self.disabled_until = time.monotonic() + PRETTIER_RETRY_SECONDS
+                raise RuntimeError(str(e))
+
+        try:
+            return self.workers.get(timeout=PRETTIER_TIMEOUT)
+
+        except queue.Empty:
+            raise RuntimeError("Prettier workers are busy")
+
+    def resolved_version(self) -> Optional[str]:
+        """Version of prettier the workers load, starting one if needed; None
+        if no worker can run."""
+        if self.version is None:
+            try:
+                self.release(self.acquire())
+            except RuntimeError:
+                return None
+
+        return self.version
+
+    def release(self, worker: PrettierWorker):
+        with self.lock:
+            running = worker in self.running
+
+        # Workers checked out while the pool was closed are already stopped
+        if running:
+            self.workers.put(worker)
+
+    def discard(self, worker: PrettierWorker):
+        worker.close()
+        with self.lock:
+            if worker in self.running:
+                self.running.discard(worker)
+                self.created -= 1
+                self.restarts += 1
+
+    def format(self, text: str, options: Dict[str, Any], resolved: bool = False) -> str:
+        """Format text; with `resolved`, options already include the file's
+        prettier config (see effective_prettier_options)."""
+        return self.call(PrettierWorker.format, text, options, resolved)
+
+    def resolve_config(self, file_path: str) -> Optional[Dict[str, Any]]:
+        """The .prettierrc/.editorconfig options prettier applies to a file."""
+        return self.call(PrettierWorker.resolve_config, file_path)
+
+    def call(self, method, *args):
+        # One retry, so a crashed worker is replaced without failing the request
+        for attempt in range(2):
+            worker = self.acquire()
+
+            try:
+                result = method(worker, *args)
+
+            except ValueError as e:
+                # prettier rejected the input; the worker itself is fine
+                if isinstance(e, json.JSONDecodeError):
+                    self.discard(worker)
+                    raise RuntimeError(f"Prettier worker sent an invalid reply: {e}")
+
+                self.release(worker)
+                raise
+
+            except (OSError, RuntimeError) as e:
+                self.discard(worker)
+                logging.warning(f"Prettier worker failed, restarting: {e}")
+                if attempt:
+                    raise RuntimeError(str(e))
+                continue
+
+            self.release(worker)
+            return result
+
+    def close(self):
+        """Stop every worker, including those checked out by a request."""
+        with self.lock:
+            workers, self.running = self.running, set()
+            self.created = 0
+
+        while True:
+            try:
+                self.workers.get_nowait()
+            except queue.Empty:
+                break
+
+        for worker in workers:
+            worker.close()
+
+
+prettier_pool = PrettierPool(PRETTIER_WORKERS)
+
+
+def run_prettier_cli(*file_paths: str):
+    prettier_cmd = [
+        "npx", "prettier", "--write",
+        "--parser", "markdown",
+        "--prose-wrap", "preserve",  # Prevents unwanted line breaks
+        "--tab-width", "2",
+        "--use-tabs", "false",
+        "--no-semi",  # Helps with bullet list issues
+        *file_paths
+    ]
+
+    prettier_result = subprocess.run(
+        prettier_cmd,
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+
+    if prettier_result.stderr:
+        raise HTTPException(status_code=500, detail=prettier_result.stderr.strip())
+
+
+class FormatCache:
+    """Digests of file contents that the prettier workers, with the current
+    version and effective options, would leave unchanged. Formatting a file whose
+    digest is recorded is skipped. Only worker results are recorded: the npx
+    fallback may resolve a different prettier version."""
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS formatted (digest TEXT PRIMARY KEY, checked REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS formatted_checked ON formatted (checked)"
+            )
+            self.conn.commit()
+
+        except (OSError, sqlite3.Error) as e:
+            logging.error(f"Format cache disabled ({path}): {e}")
+            self.conn = None
+
+    @staticmethod
+    def digest(content: str, options: Dict[str, Any], version: str) -> str:
+        return hashlib.sha256(
+            f"{version}\0{json.dumps(options, sort_keys=True)}\0{content}".encode(
+                "utf-8", "surrogatepass"
+            )
+        ).hexdigest()
+
+    def contains(self, digest: str) -> bool:
+        if self.conn is None:
+            return False
+
+        with self.lock:
+            return (
+                self.conn.execute("SELECT 1 FROM formatted WHERE digest = ?", (digest,)).fetchone()
+                is not None
+            )
+
+    def add(self, digests: list[str]):
+        if self.conn is None or not digests:
+            return
+
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO formatted VALUES (?, ?)", [(d, now) for d in digests]
+            )
+            excess = self.conn.execute("SELECT COUNT(*) FROM formatted").fetchone()[0] - self.max_size
+            if excess > 0:
+                self.conn.execute(
+                    "DELETE FROM formatted WHERE digest IN "
+                    "(SELECT digest FROM formatted ORDER BY checked LIMIT ?)",
+                    (excess,),
+                )
+            self.conn.commit()
+
+
+format_cache = FormatCache(FORMAT_CACHE_PATH, FORMAT_CACHE_SIZE)
+
+
+def resolve_format_paths(source: str, pattern: Optional[str] = None) -> list[str]:
+    """Files named by a directory (matched against `pattern`) or a glob pattern."""
+    if os.path.isdir(source):
+        matches = glob.glob(os.path.join(glob.escape(source), pattern or "**/*.md"), recursive=True)
+    else:
+        matches = glob.glob(source, recursive=True)
+
+    return sorted(os.path.abspath(path) for path in matches if os.path.isfile(path))
+
+
+def read_text(file_path: str) -> str:
+    with open(file_path, "r", encoding="utf-8", newline="") as f:
+        return f.read()
+
+
+def effective_prettier_options(file_path: str) -> Dict[str, Any]:
+    """Options a worker formats file_path with: its prettier config files,
+    overridden by prettier_options. Part of the format cache digest, so
+    editing a .prettierrc invalidates the files it applies to."""
+    return {**(prettier_pool.resolve_config(file_path) or {}), **prettier_options}
+
+
+def format_files(file_paths: list[str]) -> Dict[str, Any]:
+    """
+    Format many files in one pass over the prettier workers (or one npx run
+    per FORMAT_CLI_BATCH files), skipping files already known to be formatted.
+    """
+    started = time.perf_counter()
+    formatted, unchanged, skipped = [], [], 0
+    failed: Dict[str, str] = {}
+    pending, fallback, checked = [], [], []
+    version = prettier_pool.resolved_version()
+
+    def read(file_path: str):
+        try:
+            return read_text(file_path)
+        except (OSError, UnicodeDecodeError) as e:
+            return e
+
+    for file_path, content in zip(file_paths, io_pool.map(read, file_paths)):
+        if isinstance(content, Exception):
+            failed[file_path] = str(content)
+        else:
+            pending.append((file_path, content))
+
+    # The prettier config applying to each directory and file type, looked up
+    # once per batch rather than once per file
+    def config_key(file_path: str) -> tuple[str, str]:
+        return os.path.dirname(file_path), os.path.splitext(file_path)[1]
+
+    def resolve(file_path: str):
+        try:
+            return effective_prettier_options(file_path)
+        except (ValueError, RuntimeError) as e:
+            return e
+
+    def format_one(item: tuple[str, str]):
+        file_path, content = item
+        try:
+            if not version:
+                return prettier_pool.format(content, {**prettier_options, "filepath": file_path}), None
+
+            options = configs[config_key(file_path)]
+            if isinstance(options, Exception):
+                return options, None
+
+            if format_cache.contains(format_cache.digest(content, options, version)):
+                return None, options
+
+            return prettier_pool.format(content, {**options, "filepath": file_path}, resolved=True), options
+
+        except (ValueError, RuntimeError) as e:
+            return e, None
+
+    with ThreadPoolExecutor(max_workers=PRETTIER_WORKERS, thread_name_prefix="prettier") as pool:
+        configs: Dict[tuple[str, str], Any] = {}
+        if version:
+            keys = {config_key(file_path): file_path for file_path, _ in pending}
+            configs = dict(zip(keys, pool.map(resolve, keys.values())))
+
+        for (file_path, content), (result, options) in zip(pending, pool.map(format_one, pending)):
+            if result is None:
+                skipped += 1
+            elif isinstance(result, ValueError):
+                failed[file_path] = str(result)
+            elif isinstance(result, RuntimeError):
+                fallback.append((file_path, content))
+            elif result == content:
+                unchanged.append(file_path)
+                checked.append((result, options))
+            else:
+                with open(file_path, "w", encoding="utf-8", newline="") as f:
+                    f.write(result)
+                formatted.append(file_path)
+                checked.append((result, options))
+
+    if fallback:
+        logging.warning(f"Formatting {len(fallback)} files with npx")
+
+    for n in range(0, len(fallback), FORMAT_CLI_BATCH):
+        batch = fallback[n : n + FORMAT_CLI_BATCH]
+        try:
+            run_prettier_cli(*(file_path for file_path, _ in batch))
+        except (subprocess.CalledProcessError, HTTPException, OSError) as e:
+            error = getattr(e, "stderr", None) or getattr(e, "detail", None) or str(e)
+            failed.update((file_path, error) for file_path, _ in batch)
+            continue
+
+        for file_path, content in batch:
+            result = read_text(file_path)
+            (unchanged if result == content else formatted).append(file_path)
+
+    if version:
+        format_cache.add(
+            [format_cache.digest(content, options, version) for content, options in checked if options]
+        )
+    seconds = time.perf_counter() - started
+
+    return {
+        "files": len(file_paths),
+        "formatted": len(formatted),
+        "unchanged": len(unchanged),
+        "skipped": skipped,
+        "failed": len(failed),
+        "errors": failed,
+        "seconds": round(seconds, 3),
+    }
+
+
+def format_file(source: str = None, pattern: Optional[str] = None) -> dict:
+    if not source:
+        raise HTTPException(status_code=400, detail="Source file is required")
+
+    # Directories and glob patterns are formatted as one batch
+    if os.path.isdir(source) or glob.has_magic(source):
+        file_paths = resolve_format_paths(source, pattern)
+
+        if not file_paths:
+            raise HTTPException(status_code=404, detail="No files found")
+
+        return {
+            "message": "Files formatted",
+            "source": source,
+            **format_files(file_paths),
+            "status": "success",
+        }
+
+    file_path = os.path.abspath(source)
+
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    try:
+        # Step 1: Format with a warm prettier worker, or npx if none can run
+        content = read_text(file_path)
+        version = prettier_pool.resolved_version()
+        options = None
+
+        try:
+            if version:
+                options = effective_prettier_options(file_path)
+                if format_cache.contains(format_cache.digest(content, options, version)):
+                    return {
+                        "message": "File already formatted",
+                        "file": file_path,
+                        "method": "cache",
+                        "status": "success",
+                    }
+
+            formatted_content = prettier_pool.format(
+                content, {**(options or prettier_options), "filepath": file_path}, resolved=bool(options)
+            )
+            method = "worker"
+
+            if formatted_content != content:
+                with open(file_path, "w", encoding="utf-8", newline="") as f:
+                    f.write(formatted_content)
+
+        except ValueError as e:
+            raise HTTPException(status_code=500, detail=f"Formatting Error: {e}")
+
+        except RuntimeError as e:
+            logging.warning(f"Formatting {file_path} with npx: {e}")
+            run_prettier_cli(file_path)
+            method = "npx"
+
+            with open(file_path, "r", encoding="utf-8") as f:
+                formatted_content = f.read()
+
+        # Step 2: Verify Formatting & Fallback to remark-cli if needed
+        # Check if formatting is incorrect (example heuristic)
+        if "  +" in formatted_content or formatted_content.count("\n") < 3:
+            # Fallback to remark-cli if Prettier messed up the structure
+            remark_cmd = ["npx", "remark", "--output", file_path]
+            subprocess.run(remark_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+        elif method == "worker" and options:
+            format_cache.add([format_cache.digest(formatted_content, options, version)])
+
+        return {
+            "message": "File formatted successfully",
+            "file": file_path,
+            "method": method,
+            "status": "success",
+        }
+
+    except HTTPException:
+        raise
+
+    except subprocess.CalledProcessError as e:
+        raise HTTPException(status_code=500, detail=f"Formatting Error: {e.stderr}")
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+
+
+# A3. Count the number of week-days in the list of dates
+day_names = [
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+]
+
+
+month_numbers = {
+    month: number
+    for number, month in enumerate(
+        ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"],
+        start=1,
+    )
+}
+
+
+def parse_known_date(text: str) -> Optional[date]:
+    """Decode the date formats written by datagen.get_dates using cheap
+    length and separator checks. Returns None for any other shape."""
+    n = len(text)
+
+    try:
+        # %Y-%m-%d, e.g. 2024-03-14
+        if n == 10 and text[4] == "-" and text[7] == "-":
+            return date(int(text[:4]), int(text[5:7]), int(text[8:]))
+
+        # %d-%b-%Y, e.g. 14-Mar-2024
+        if n == 11 and text[2] == "-" and text[6] == "-":
+            return date(int(text[7:]), month_numbers[text[3:6].lower()], int(text[:2]))
+
+        # %b %d, %Y, e.g. Mar 14, 2024
+        if n == 12 and text[3] == " " and text[6] == ",":
+            return date(int(text[8:]), month_numbers[text[:3].lower()], int(text[4:6]))
+
+        # %Y/%m/%d %H:%M:%S, e.g. 2024/03/14 15:30:45
+        if n == 19 and text[4] == "/" and text[7] == "/" and text[13] == ":" and text[16] == ":":
+            return date(int(text[:4]), int(text[5:7]), int(text[8:10]))
+
+    except (KeyError, ValueError):
+        pass
+
+    return None
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date_ordinal(text: str) -> tuple[int, bool]:
+    """Proleptic Gregorian ordinal of a date string, and whether it needed
+    the dateutil fallback."""
+    parsed = parse_known_date(text)
+
+    if parsed is None:
+        return parser.parse(text).toordinal(), True
+
+    return parsed.toordinal(), False
+
+
+def weekday_histogram(ordinals: list[int]) -> np.ndarray:
+    # Ordinal 1 (0001-01-01) is a Monday, so Monday is 0 like date.weekday()
+    return np.bincount((np.array(ordinals, dtype=np.int64) + 6) % 7, minlength=7)
+
+
+def weekday_histogram_shard(path: str, start: int, end: int) -> tuple[np.ndarray, int]:
+    histogram = np.zeros(7, dtype=np.int64)
+    ordinals: list[int] = []
+    fallbacks = 0
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line_start, line_end in iter_line_range(mm, start, end):
+            line = mm[line_start:line_end].decode("utf-8").strip()
+            if line:
+                ordinal, fallback = parse_date_ordinal(line)
+                ordinals.append(ordinal)
+                fallbacks += fallback
+
+                # Fold into the histogram in bounded batches
+                if len(ordinals) >= 1 << 20:
+                    histogram += weekday_histogram(ordinals)
+                    ordinals.clear()
+
+    histogram += weekday_histogram(ordinals)
+
+    return histogram, fallbacks
+
+
+# Weekday histograms keyed by (path, size, mtime), in memory and on disk, so
+# follow-up questions about the same unchanged file need no parsing
+weekday_histograms: Dict[str, Dict[str, Any]] = {}
+
+
+def weekday_histogram_path(file_path: str) -> str:
+    key = hashlib.sha256(os.path.abspath(file_path).encode()).hexdigest()
+    return os.path.join(WEEKDAY_CACHE_DIR, f"{key}.json")
+
+
+def load_weekday_histogram(file_path: str) -> Dict[str, Any]:
+    stat = os.stat(file_path)
+    fingerprint = {
+        "path": os.path.abspath(file_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+    entry = weekday_histograms.get(fingerprint["path"])
+
+    if entry is None or any(entry[k] != v for k, v in fingerprint.items()):
+        try:
+            with open(weekday_histogram_path(file_path), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+
+    if entry is not None and all(entry.get(k) == v for k, v in fingerprint.items()):
+        weekday_histograms[fingerprint["path"]] = entry
+        return {**entry, "cached": True}
+
+    partials = scan_lines(file_path, weekday_histogram_shard)
+    entry = {
+        **fingerprint,
+        "histogram": [int(n) for n in sum((h for h, _ in partials), np.zeros(7, dtype=np.int64))],
+        "fallbacks": sum(fallback for _, fallback in partials),
+    }
+    weekday_histograms[fingerprint["path"]] = entry
+
+    try:
+        os.makedirs(WEEKDAY_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{weekday_histogram_path(file_path)}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, weekday_histogram_path(file_path))
+
+    except OSError as e:
+        logging.warning(f"Weekday histogram not saved for {file_path}: {e}")
+
+    return {**entry, "cached": False}
+
+
+def count_weekday(
+    weekday: str, source: str = None, destination: str = None, histogram: bool = False
+) -> dict:
+    weekday = normalize_weekday(weekday)
+    weekday_index = day_names.index(weekday)
+
+    if not source:
+        raise HTTPException(status_code=400, detail="Source file is required")
+
+    file_path: str = source
+    output_path: str = destination or file_rename(file_path, f"-{weekday}.txt")
+
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    entry = load_weekday_histogram(file_path)
+    day_count = entry["histogram"][weekday_index]
+
+    with open(output_path, "w") as f:
+        f.write(str(day_count))
+
+    result = {
+        "message": f"{weekday} counted",
+        "count": day_count,
+        "fallbacks": entry["fallbacks"],
+        "cached": entry["cached"],
+        "source": file_path,
+        "destination": output_path,
+        "status": "success",
+    }
+
+    if histogram:
+        result["histogram"] = dict(zip(day_names, entry["histogram"]))
+
+    return result
+
+
+def normalize_weekday(weekday):
+    if isinstance(weekday, int):  # If input is an integer (0-6)
+        return day_names[weekday % 7]
+
+    elif isinstance(weekday, str):  # If input is a string
+        weekday = weekday.strip().lower()
+        days = {day.lower(): day for day in day_names}
+        short_days = {day[:3].lower(): day for day in day_names}
+
+        if weekday in days:
+            return days[weekday]
+
+        elif weekday in short_days:
+            return short_days[weekday]
+
+    raise ValueError("Invalid weekday input")
+
+
+# A4. Sort the array of contacts by last name and first name
+contact_name_fields = ["last_name", "first_name"]
+
+
+def contact_sort_key(order: Union[str, list[str]]):
+    """Case-insensitive compound key: the requested field(s) first, then the
+    remaining name fields as tie breakers."""
+    fields = [order] if isinstance(order, str) else list(order)
+    fields += [field for field in contact_name_fields if field not in fields]
+
+    return lambda contact: tuple(str(contact.get(field) or "").lower() for field in fields)
+
+
+def iter_json_array(path: str, chunk_size: int = 1 << 20, offsets: bool = False):
+    """Yield the items of a top-level JSON array without loading the file.
+
+    With offsets=True, yields (item, start, end) where start/end are the
+    byte offsets of the item's JSON text in the file.
+    """
+    decoder = json.JSONDecoder()
+    state = "start"
+
+    # newline="" keeps \r\n intact so character counts map to file bytes
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        buffer, pos, eof = "", 0, False
+
+        # mark is a buffer position whose byte offset in the file is mark_bytes
+        mark, mark_bytes = 0, 0
+
+        def advance(to: int) -> int:
+            nonlocal mark, mark_bytes
+            if offsets:
+                mark_bytes += len(buffer[mark:to].encode("utf-8"))
+            mark = to
+            return mark_bytes
+
+        def refill():
+            nonlocal buffer, pos, eof, mark
+            advance(pos)
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer, pos, mark = buffer[pos:] + chunk, 0, 0
+
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+
+            # A value ending exactly at the buffer end may be cut short (e.g. a number)
+            if pos >= len(buffer) or (state == "value" and not eof and pos > len(buffer) - 64):
+                if eof and pos >= len(buffer):
+                    raise ValueError(f"Unexpected end of JSON array in {path}")
+                refill()
+                continue
+
+            if state == "start":
+                if buffer[pos] != "[":
+                    raise ValueError(f"{path} does not contain a JSON array")
+                pos += 1
+                state = "first"
+
+            elif state == "first" and buffer[pos] == "]":
+                return
+
+            elif state in ("first", "value"):
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    refill()
+                    continue
+
+                if end == len(buffer) and not eof:
+                    refill()
+                    continue
+
+                if offsets:
+                    yield item, advance(pos), advance(end)
+                else:
+                    yield item
+
+                pos = end
+                state = "separator"
+
+            elif buffer[pos] == ",":
+                pos += 1
+                state = "value"
+
+            elif buffer[pos] == "]":
+                return
+
+            else:
+                raise ValueError(f"Malformed JSON array in {path} near: {buffer[pos:pos + 20]!r}")
+
+
+def write_json_array(path: str, items):
+    """Write items exactly as json.dump(items, f, indent=4) would, streaming."""
+    with open(path, "w") as f:
+        first = True
+        for item in items:
+            f.write("[\n" if first else ",\n")
+            f.write(textwrap.indent(json.dumps(item, indent=4), "    "))
+            first = False
+
+        f.write("[]" if first else "\n]")
+
+
+def write_sorted_run(directory: str, items: list) -> str:
+    fd, path = tempfile.mkstemp(suffix=".jsonl", dir=directory)
+
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        for item in items:
+            f.write(json.dumps(item) + "\n")
+
+    return path
+
+
+def read_sorted_run(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def sort_json_array_external(source: str, destination: str, key) -> int:
+    """External merge sort: sort runs of CONTACTS_RUN_SIZE items in memory,
+    spill them to temporary JSON Lines files and k-way merge them into
+    destination. Returns the number of items."""
+    directory = tempfile.mkdtemp(prefix=".sort-", dir=os.path.dirname(os.path.abspath(destination)))
+    runs: list[str] = []
+    batch: list = []
+    count = 0
+
+    try:
+        for item in iter_json_array(source):
+            batch.append(item)
+            count += 1
+
+            if len(batch) >= CONTACTS_RUN_SIZE:
+                batch.sort(key=key)
+                runs.append(write_sorted_run(directory, batch))
+                batch = []
+
+        batch.sort(key=key)
+
+        # Merge in passes so no more than CONTACTS_MERGE_FAN_IN runs are open at once
+        while len(runs) + bool(batch) > CONTACTS_MERGE_FAN_IN:
+            merged = []
+            for i in range(0, len(runs), CONTACTS_MERGE_FAN_IN):
+                group = runs[i : i + CONTACTS_MERGE_FAN_IN]
+                merged.append(
+                    write_sorted_run(
+                        directory, heapq.merge(*(read_sorted_run(r) for r in group), key=key)
+                    )
+                )
+                for run in group:
+                    os.remove(run)
+            runs = merged
+
+        # Runs are merged in input order, which keeps the sort stable like sorted()
+        tmp_path = os.path.join(directory, "sorted.json")
+        write_json_array(
+            tmp_path, heapq.merge(*(read_sorted_run(r) for r in runs), iter(batch), key=key)
+        )
+        os.replace(tmp_path, destination)
+
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    return count
+
+
+# Name index: a SQLite file next to a contacts JSON array, mapping lower-cased
+# names to byte ranges in the file, so prefix and range lookups do not need
+# to load the JSON. It is rebuilt when the file's size or mtime changes.
+def contacts_index_path(path: str) -> str:
+    return f"{path}.index.db"
+
+
+def file_fingerprint(path: str) -> tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build_contacts_index(path: str) -> str:
+    index_path = contacts_index_path(path)
+    tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    size, mtime_ns = file_fingerprint(path)
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("CREATE TABLE meta (size INTEGER, mtime_ns INTEGER)")
+        conn.execute(
+            "CREATE TABLE contacts "
+            "(last_name TEXT, first_name TEXT, offset INTEGER, length INTEGER)"
+        )
+
+        batch = []
+        for contact, start, end in iter_json_array(path, offsets=True):
+            names = contact if isinstance(contact, dict) else {}
+            batch.append(
+                (
+                    str(names.get("last_name") or "").lower(),
+                    str(names.get("first_name") or "").lower(),
+                    start,
+                    end - start,
+                )
+            )
+            if len(batch) >= 10_000:
+                conn.executemany("INSERT INTO contacts VALUES (?, ?, ?, ?)", batch)
+                batch = []
+
+        conn.executemany("INSERT INTO contacts VALUES (?, ?, ?, ?)", batch)
+
+        # Covering indexes: lookups never touch the table itself
+        conn.execute(
+            "CREATE INDEX contacts_last ON contacts (last_name, first_name, offset, length)"
+        )
+        conn.execute(
+            "CREATE INDEX contacts_first ON contacts (first_name, last_name, offset, length)"
+        )
+        conn.execute("INSERT INTO meta VALUES (?, ?)", (size, mtime_ns))
+        conn.commit()
+
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, index_path)
+
+    return index_path
+
+
+def open_contacts_index(path: str) -> sqlite3.Connection:
+    index_path = contacts_index_path(path)
+
+    if os.path.exists(index_path):
+        conn = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+        try:
+            if conn.execute("SELECT size, mtime_ns FROM meta").fetchone() == file_fingerprint(path):
+                return conn
+        except sqlite3.Error:
+            pass
+        conn.close()
+
+    build_contacts_index(path)
+
+    return sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+
+
+def lookup_contacts(
+    source: str = None,
+    prefix: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    field: str = "last_name",
+    limit: int = 100,
+    destination: Optional[str] = None,
+):
+    if not source:
+        raise HTTPException(status_code=400, detail="Source file is required")
+
+    if not os.path.exists(source):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    if field not in contact_name_fields:
+        raise HTTPException(status_code=400, detail=f"Field must be one of {contact_name_fields}")
+
+    other = next(f for f in contact_name_fields if f != field)
+    conditions, params = [], []
+
+    if prefix:
+        prefix = prefix.lower()
+        conditions.append(f"{field} >= ? AND {field} < ?")
+        params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+
+    if start:
+        conditions.append(f"{field} >= ?")
+        params.append(start.lower())
+
+    if end:
+        conditions.append(f"{field} < ?")
+        params.append(end.lower())
+
+    conn = open_contacts_index(source)
+    try:
+        rows = conn.execute(
+            f"SELECT offset, length FROM contacts "
+            f"{'WHERE ' + ' AND '.join(conditions) if conditions else ''} "
+            f"ORDER BY {field}, {other}, offset LIMIT ?",
+            [*params, max(0, limit)],
+        ).fetchall()
+    finally:
+        conn.close()
+
+    contacts = []
+    with open(source, "rb") as f:
+        for offset, length in rows:
+            f.seek(offset)
+            contacts.append(json.loads(f.read(length)))
+
+    if destination:
+        with open(destination, "w") as f:
+            json.dump(contacts, f, indent=4)
+
+    return {
+        "message": "Contacts found",
+        "count": len(contacts),
+        "contacts": contacts,
+        "source": source,
+        "destination": destination,
+        "status": "success",
+    }
+
+
+@app.get("/contacts")
+def contacts_lookup(
+    source: str,
+    prefix: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    field: str = "last_name",
+    limit: int = 100,
+) -> dict:
+    return lookup_contacts(source, prefix, start, end, field, limit)
+
+
+def sort_contacts(
+    order: Union[str, list[str]],
+    source: Optional[str],
+    destination: Optional[str],
+    streaming: Optional[bool] = None,
+    index: Optional[bool] = False,
+):
+    logger.info(f"Sorting contacts from {source}, order: {order}, writing to {destination}")
+
+    if not source or not os.path.exists(source):
+        raise HTTPException(status_code=400, detail="Source file not found")
+
+    if not destination:
+        raise HTTPException(status_code=400, detail="Destination file not provided")
+
+    key = contact_sort_key(order or "last_name")
+
+    if streaming is None:
+        streaming = os.path.getsize(source) > CONTACTS_STREAM_BYTES
+
+    try:
+        if streaming:
+            count = sort_json_array_external(source, destination, key)
+
+        else:
+            with open(source, "r") as f:
+                contacts = json.load(f)
+
+            sorted_contacts = sorted(contacts, key=key)
+            count = len(sorted_contacts)
+
+            with open(destination, "w") as f:
+                json.dump(sorted_contacts, f, indent=4)
+
+        if index:
+            build_contacts_index(destination)
+
+        logger.info(f"Sorted contacts written successfully to {destination}")
+        return {"message": "Contacts sorted successfully", "count": count, "streaming": streaming}
+
+    except Exception as e:
+        logger.error(f"Error sorting contacts: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+# A5. Write the first line of the 10 most recent .log file in /data/logs/ to /data/logs-recent.txt, most recent first
+def iter_log_files(directory: str, recursive: bool = False):
+    """Yield (mtime, path) for each .log file, with one stat per file."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(".log"):
+                yield entry.stat().st_mtime, entry.path
+
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                yield from iter_log_files(entry.path, recursive)
+
+
+def read_first_line(path: str, limit: int = LOG_LINE_MAX_BYTES) -> str:
+    with open(path, "rb") as f:
+        data = f.read(limit)
+
+    return data.split(b"\n", 1)[0].decode("utf-8", errors="replace").strip()
+
+
+class LogIndex:
+    """On-disk (name, mtime, size, first line) index of the .log files under
+    a directory, ordered by mtime.
+
+    A refresh only lists directories whose own mtime changed (files were
+    added, removed or renamed) and only re-reads files whose mtime or size
+    changed. Directory mtimes do not change when a file is appended to in
+    place, so the entries returned by recent() are re-stat'd before use and
+    every directory is re-listed at least every LOG_INDEX_FULL_REFRESH seconds.
+    """
+
+    def __init__(self, root: str, recursive: bool = False):
+        self.root = os.path.abspath(root)
+        self.recursive = recursive
+        self.lock = threading.Lock()
+        self.full_refreshed = float("-inf")
+
+        key = hashlib.sha256(f"{self.root}:{recursive}".encode()).hexdigest()
+        os.makedirs(LOG_INDEX_DIR, exist_ok=True)
+
+        self.conn = sqlite3.connect(
+            os.path.join(LOG_INDEX_DIR, f"{key}.db"), check_same_thread=False
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dirs "
+            "(path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, first_line TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime_ns DESC)")
+        self.conn.commit()
+
+    def refresh(self):
+        full = time.monotonic() - self.full_refreshed > LOG_INDEX_FULL_REFRESH
+        pending = [(self.root, None)]
+
+        while pending:
+            directory, parent = pending.pop()
+
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+
+            except FileNotFoundError:
+                self.forget_dir(directory)
+                continue
+
+            row = self.conn.execute(
+                "SELECT mtime_ns FROM dirs WHERE path = ?", (directory,)
+            ).fetchone()
+
+            if row and row[0] == mtime_ns and not full:
+                pending.extend(
+                    (path, directory)
+                    for (path,) in self.conn.execute(
+                        "SELECT path FROM dirs WHERE parent = ?", (directory,)
+                    )
+                )
+                continue
+
+            pending.extend((path, directory) for path in self.rescan_dir(directory))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?)",
+                (directory, parent, mtime_ns),
+            )
+
+        self.conn.commit()
+
+        if full:
+            self.full_refreshed = time.monotonic()
+
+    def rescan_dir(self, directory: str) -> list[str]:
+        known = {
+            path: (mtime_ns, size)
+            for path, mtime_ns, size in self.conn.execute(
+                "SELECT path, mtime_ns, size FROM files WHERE dir = ?", (directory,)
+            )
+        }
+        subdirs = []
+
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(".log"):
+                    stat = entry.stat()
+                    if known.pop(entry.path, None) != (stat.st_mtime_ns, stat.st_size):
+                        self.update_file(entry.path, directory, stat)
+
+                elif self.recursive and entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+
+        self.conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in known])
+
+        for (path,) in self.conn.execute(
+            "SELECT path FROM dirs WHERE parent = ?", (directory,)
+        ).fetchall():
+            if path not in subdirs:
+                self.forget_dir(path)
+
+        return subdirs
+
+    def update_file(self, path: str, directory: str, stat: os.stat_result):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files (path, dir, mtime_ns, size, first_line) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (path, directory, stat.st_mtime_ns, stat.st_size, read_first_line(path)),
+        )
+
+    def forget_dir(self, directory: str):
+        for (path,) in self.conn.execute(
+            "SELECT path FROM dirs WHERE parent = ?", (directory,)
+        ).fetchall():
+            self.forget_dir(path)
+
+        self.conn.execute("DELETE FROM files WHERE dir = ?", (directory,))
+        self.conn.execute("DELETE FROM dirs WHERE path = ?", (directory,))
+
+    def recent(self, count: int) -> Optional[list[tuple[str, str]]]:
+        """(path, first line) of the count most recently modified files, or
+        None if the files keep changing under the index."""
+        with self.lock:
+            self.refresh()
+
+            for _ in range(3):
+                rows = self.conn.execute(
+                    "SELECT path, dir, mtime_ns, size, first_line FROM files "
+                    "ORDER BY mtime_ns DESC, path LIMIT ?",
+                    (count,),
+                ).fetchall()
+
+                stale = False
+                for path, directory, mtime_ns, size, _ in rows:
+                    try:
+                        stat = os.stat(path)
+                        if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size):
+                            self.update_file(path, directory, stat)
+                            stale = True
+
+                    except FileNotFoundError:
+                        self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                        stale = True
+
+                if not stale:
+                    return [(path, first_line) for path, _, _, _, first_line in rows]
+
+                self.conn.commit()
+
+            return None
+
+
+log_indexes: Dict[tuple[str, bool], LogIndex] = {}
+log_indexes_lock = threading.Lock()
+
+
+def get_log_index(directory: str, recursive: bool = False) -> LogIndex:
+    key = (os.path.abspath(directory), recursive)
+
+    with log_indexes_lock:
+        if key not in log_indexes:
+            log_indexes[key] = LogIndex(directory, recursive)
+
+        return log_indexes[key]
+
+
+def write_recent_logs(
+    count: int,
+    source: str = None,
+    destination: str = None,
+    recursive: bool = False,
+    indexed: Optional[bool] = None,
+):
+    if count < 1:
+        raise HTTPException(status_code=400, detail="Invalid count")
+
+    if not source:
+        raise HTTPException(status_code=400, detail="Source file is required")
+
+    file_path: str = source
+    file_dir: str = os.path.dirname(file_path)
+    output_path: str = destination or os.path.join(DATA_DIR, f"{file_dir}-recent.txt")
+
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    recent = None
+
+    if LOG_INDEX if indexed is None else indexed:
+        recent = get_log_index(file_path, recursive).recent(count)
+        if recent is None:
+            logging.warning(f"Log index for {file_path} kept changing, scanning instead")
+
+    if recent is not None:
+        first_lines = [first_line for _, first_line in recent]
+
+    else:
+        # Bounded heap instead of sorting every file; ties keep directory order
+        recent = heapq.nlargest(count, iter_log_files(file_path, recursive), key=lambda f: f[0])
+        first_lines = io_pool.map(read_first_line, [path for _, path in recent])
+
+    with open(output_path, "w") as out:
+        for first_line in first_lines:
+            out.write(f"{first_line}\n")
+
+    return {
+        "message": "Recent logs written",
+        "log_dir": file_path,
+        "output_file": output_path,
+        "count": len(recent),
+        "status": "success",
+    }
+
+
+# A6. Index for Markdown (.md) files in /data/docs/
+def extract_markdown_titles(
+    source: str = None, destination: str = None, watch: bool = False, full: bool = False
+):
+    if not source:
+        raise HTTPException(status_code=400, detail="Source file is required")
+
+    file_path: str = source
+    output_path: str = destination or os.path.join(file_path, "index.json")
+
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="Directory not found")
+
+    stats = update_markdown_index(file_path, output_path, full)
+
+    if watch:
+        start_markdown_watch(file_path, output_path)
+
+    return {
+        "message": "Markdown titles extracted",
+        "file_dir": file_path,
+        "index_file": output_path,
+        **stats,
+        "watching": (os.path.abspath(file_path), os.path.abspath(output_path)) in markdown_watchers,
+        "status": "success",
+    }
+
+
+def iter_markdown_files(directory: str):
+    pending = [directory]
+
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.endswith(".md") and entry.is_file():
+                    yield entry
+
+
+def read_markdown_title(file_path: str, chunk_size: int = MARKDOWN_READ_CHUNK) -> Optional[str]:
+    """Title of the first "# " line, reading only as far as that line."""
+    with open(file_path, "rb") as f:
+        carry = b""
+        skipping = False
+
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                if not skipping and carry.startswith(b"# "):
+                    return carry[2:].decode("utf-8", errors="replace").strip()
+                return None
+
+            lines = (carry + chunk).split(b"\n")
+            carry = lines.pop()
+
+            for line in lines:
+                if skipping:
+                    # Tail of a long line that was already ruled out
+                    skipping = False
+                elif line.startswith(b"# "):
+                    return line[2:].decode("utf-8", errors="replace").strip()
+
+            # Long lines that cannot be a heading are dropped, not buffered
+            if skipping or (len(carry) >= 2 and not carry.startswith(b"# ")):
+                carry, skipping = b"", True
+
+
+markdown_index_lock = threading.Lock()
+markdown_watchers: Dict[tuple, threading.Event] = {}
+markdown_watchers_lock = threading.Lock()
+
+
+def markdown_manifest_path(output_path: str) -> str:
+    return f"{output_path}.manifest.json"
+
+
+def load_markdown_manifest(output_path: str, directory: str) -> Optional[dict]:
+    try:
+        with open(markdown_manifest_path(output_path)) as f:
+            manifest = json.load(f)
+
+    except (OSError, ValueError):
+        return None
+
+    # A manifest for another tree, or an index edited behind our back, is useless
+    try:
+        index_mtime = os.stat(output_path).st_mtime_ns
+    except OSError:
+        return None
+
+    if manifest.get("directory") != os.path.abspath(directory) or manifest.get("index_mtime") != index_mtime:
+        return None
+
+    return manifest.get("files", {})
+
+
+def replace_json(path: str, data, **kwargs):
+    """Write JSON through a temp file in the same directory, so readers only
+    ever see the old or the new file."""
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with open(fd, "w") as f:
+            json.dump(data, f, **kwargs)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def update_markdown_index(directory: str, output_path: str, full: bool = False) -> Dict[str, Any]:
+    """
+    Bring the title index up to date, reading only Markdown files whose
+    (inode, size, mtime) differ from the manifest stored next to the index.
+    """
+    with markdown_index_lock:
+        started = time.perf_counter()
+        manifest = None if full else load_markdown_manifest(output_path, directory)
+        previous = manifest or {}
+
+        files, changed = {}, []
+        for entry in iter_markdown_files(directory):
+            relative_path = re.sub(r"[\\/]+", "/", os.path.relpath(entry.path, directory))
+            stat = entry.stat()
+            fingerprint = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+            # Stat before reading, so a file changed mid-read is picked up next time
+            if previous.get(relative_path, [])[:3] == fingerprint:
+                files[relative_path] = previous[relative_path]
+            else:
+                changed.append((relative_path, entry.path, fingerprint))
+
+        titles = io_pool.map(read_markdown_title, [path for _, path, _ in changed])
+        for (relative_path, _, fingerprint), title in zip(changed, titles):
+            files[relative_path] = fingerprint + [title]
+
+        removed = len(previous.keys() - files.keys())
+        index = {path: files[path][3] for path in sorted(files) if files[path][3]}
+
+        # Touched files with unchanged titles only refresh the manifest
+        rebuilt = manifest is None or index != {
+            path: entry[3] for path, entry in sorted(previous.items()) if entry[3]
+        }
+
+        if rebuilt:
+            replace_json(output_path, index, indent=4)
+
+        if rebuilt or changed or removed:
+            manifest = {
+                "directory": os.path.abspath(directory),
+                "index_mtime": os.stat(output_path).st_mtime_ns,
+                "files": files,
+            }
+            try:
+                replace_json(markdown_manifest_path(output_path), manifest)
+
+            except OSError as e:
+                logging.warning(f"Markdown manifest not saved for {output_path}: {e}")
+
+        seconds = time.perf_counter() - started
+
+        return {
+            "files": len(files),
+            "read": len(changed),
+            "removed": removed,
+            "untitled": sum(1 for entry in files.values() if not entry[3]),
+            "rebuilt": rebuilt,
+            "seconds": round(seconds, 3),
+            "files_per_second": round(len(files) / seconds, 1) if seconds else None,
+        }
+
+
+def start_markdown_watch(directory: str, output_path: str):
+    """Poll the tree in the background; polling also works on network storage."""
+    key = (os.path.abspath(directory), os.path.abspath(output_path))
+
+    with markdown_watchers_lock:
+        if key in markdown_watchers:
+            return
+
+        stop = markdown_watchers[key] = threading.Event()
+
+    def watch():
+        while not stop.wait(MARKDOWN_WATCH_INTERVAL):
+            try:
+                stats = update_markdown_index(directory, output_path)
+                if stats["rebuilt"]:
+                    logging.info(f"Markdown index {output_path} updated: {stats}")
+
+            except Exception as e:
+                logging.warning(f"Markdown index {output_path} not updated: {e}")
+
+    threading.Thread(target=watch, name=f"markdown-watch:{directory}", daemon=True).start()
+
+
+def stop_markdown_watchers():
+    with markdown_watchers_lock:
+        while markdown_watchers:
+            markdown_watchers.popitem()[1].set()
+
+
+# A7. Extract the sender's email address from an email message
+def extract_email_sender(source: str = None, destination: str = None):
     if not source:
         raise HTTPException(status_code=400, detail="Source file is required")
 
-    file_path = os.path.abspath(source)
+    file_path: str = source
+    output_path: str = destination or file_rename(file_path, "-sender.txt")
 
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
 
-    try:
-        # Step 1: Run Prettier with improved options
-        prettier_cmd = [
-            "npx", "prettier", "--write",
-            "--parser", "markdown",
-            "--prose-wrap", "preserve",  # Prevents unwanted line breaks
-            "--tab-width", "2",
-            "--use-tabs", "false",
-            "--no-semi",  # Helps with bullet list issues
-            file_path
-        ]
+    with open(file_path, "r") as f:
+        email_content = f.read()
+
+    response = get_chat_completions(
+        [
+            {"role": "system", "content": "Extract the sender's email."},
+            {"role": "user", "content": email_content},
+        ]
+    )
+
+    extracted_email = response["content"].strip()
+
+    with open(output_path, "w") as f:
+        f.write(extracted_email)
+
+    return {
+        "message": "Email extracted",
+        "source": file_path,
+        "destination": output_path,
+        "status": "success",
+    }
+
+
+# A8. Extract credit card number.
+def encode_image(image_path: str, format: str):
+    image = Image.open(image_path)
+
+    buffer = BytesIO()
+    image.save(buffer, format=format)
+    image_bytes = buffer.getvalue()
+
+    base64_image = base64.b64encode(image_bytes).decode("utf-8")
+
+    return base64_image
+
+
+class OcrReaderPool:
+    """Up to `size` EasyOCR readers, created on first use (or at startup with
+    OCR_PRELOAD) and handed out one request at a time. Requests beyond the
+    pool size wait in the queue for a reader to come back, or for a failed
+    load to free its slot."""
+
+    # Queued in place of a reader that failed to load
+    FAILED = object()
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self.readers: queue.Queue = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def create_reader():
+        import easyocr
+
+        return easyocr.Reader(["en"])
+
+    def preload(self):
+        readers = []
+        try:
+            while len(readers) < self.size:
+                readers.append(self.acquire())
+
+        finally:
+            for reader in readers:
+                self.readers.put(reader)
+
+    def acquire(self):
+        deadline = time.monotonic() + OCR_QUEUE_TIMEOUT
+
+        while True:
+            with self.lock:
+                create = self.readers.empty() and self.created < self.size
+                if create:
+                    self.created += 1
+
+            if create:
+                try:
+                    logging.info(f"Loading OCR reader {self.created}/{self.size}")
+                    return self.create_reader()
+
+                except BaseException:
+                    with self.lock:
+                        self.created -= 1
+                    # Wake a waiting request to retry the load itself rather than time out
+                    self.readers.put(self.FAILED)
+                    raise
+
+            try:
+                reader = self.readers.get(timeout=max(0.0, deadline - time.monotonic()))
+
+            except queue.Empty:
+                raise HTTPException(status_code=503, detail="OCR readers are busy, try again")
+
+            if reader is not self.FAILED:
+                return reader
+
+    @contextmanager
+    def reader(self):
+        reader = self.acquire()
+        try:
+            yield reader
+        finally:
+            self.readers.put(reader)
+
+
+ocr_pool = OcrReaderPool(OCR_POOL_SIZE)
+
+
+card_number_pattern = re.compile(
+    r"\b(?:4\d{12}(?:\d{3})?|5[1-5]\d{14}|3[47]\d{13}|6(?:011|5\d{2})\d{12}|3(?:0[0-5]|[68]\d)\d{11}|(?:2131|1800|35\d{3})\d{11})\b"
+)
+
+
+def luhn_valid(number: str) -> bool:
+    total = 0
+    for i, digit in enumerate(reversed(number)):
+        value = int(digit) * (2 if i % 2 else 1)
+        total += value - 9 if value > 9 else value
+
+    return bool(number) and total % 10 == 0
+
+
+def binarize_image(image: Image.Image) -> np.ndarray:
+    """Ink mask of a single-colour-background image: pixels far from the
+    median grey level."""
+    gray = np.asarray(image.convert("L"), dtype=np.int16)
+    contrast = np.abs(gray - int(np.median(gray)))
+
+    return contrast > max(32, int(contrast.max()) // 2)
+
+
+def ink_runs(profile: np.ndarray) -> list[tuple[int, int]]:
+    """(start, end) of each run of non-zero entries in a projection profile."""
+    ink = np.concatenate([[0], (profile > 0).astype(np.int8), [0]])
+    edges = np.flatnonzero(np.diff(ink))
+
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+
+@functools.lru_cache(maxsize=1)
+def digit_templates() -> Dict[str, np.ndarray]:
+    # datagen.a8_credit_card_image draws the number with Pillow's default font
+    font = ImageFont.load_default()
+    masks = {}
+
+    for digit in "0123456789":
+        image = Image.new("L", (64, 64), 0)
+        ImageDraw.Draw(image).text((8, 8), digit, fill=255, font=font)
+        masks[digit] = np.asarray(image) > 127
+
+    # Share one row window so every template has the band's height
+    rows = ink_runs(np.any(np.stack(list(masks.values())), axis=(0, 2)))
+    top, bottom = rows[0][0], rows[-1][1]
+
+    templates = {}
+    for digit, mask in masks.items():
+        runs = ink_runs(mask.any(axis=0))
+        templates[digit] = mask[top:bottom, runs[0][0] : runs[-1][1]]
+
+    return templates
+
+
+def match_digits(band: np.ndarray) -> tuple[str, float]:
+    """Read a line of digits left to right by matching the templates at each
+    glyph's left edge. Returns the digits and the worst match score."""
+    templates = digit_templates()
+    height = next(iter(templates.values())).shape[0]
+
+    if band.shape[0] != height:
+        scale = height / band.shape[0]
+        resized = Image.fromarray(band.astype(np.uint8) * 255).resize(
+            (max(1, round(band.shape[1] * scale)), height), Image.BILINEAR
+        )
+        band = np.asarray(resized) > 127
+
+    columns = band.any(axis=0)
+    digits, confidence = [], 1.0
+    x = 0
+
+    while x < band.shape[1]:
+        if not columns[x]:
+            x += 1
+            continue
+
+        best_score, best_digit = 0.0, None
+        for digit, template in templates.items():
+            window = band[:, x : x + template.shape[1]]
+            if window.shape != template.shape:
+                continue
+
+            union = np.count_nonzero(window | template)
+            score = np.count_nonzero(window & template) / union if union else 0.0
+            if score > best_score:
+                best_score, best_digit = score, digit
+
+        if best_digit is None or best_score < OCR_TEMPLATE_MIN_SCORE:
+            return "".join(digits), 0.0
+
+        digits.append(best_digit)
+        confidence = min(confidence, best_score)
+        x += templates[best_digit].shape[1]
+
+    return "".join(digits), confidence
+
+
+def recognize_card_number(
+    image: Image.Image,
+) -> tuple[Optional[str], float, Optional[tuple[int, int, int, int]]]:
+    """Fast path for synthetic card images: template-match every text line
+    and accept the first that is a plausible, Luhn-valid card number.
+
+    Returns the number, its confidence and the (left, top, right, bottom)
+    box of the longest line read as digits. That box is returned even when
+    the number fails validation, as a hint for the OCR fallback.
+    """
+    mask = binarize_image(image)
+    best_length, best_region = 0, None
+
+    for top, bottom in ink_runs(mask.sum(axis=1)):
+        band = mask[top:bottom]
+        digits, confidence = match_digits(band)
+
+        if not confidence or len(digits) <= best_length:
+            continue
+
+        columns = ink_runs(band.any(axis=0))
+        best_length, best_region = len(digits), (columns[0][0], top, columns[-1][1], bottom)
+
+        if card_number_pattern.fullmatch(digits) and luhn_valid(digits):
+            return digits, confidence, best_region
+
+    return None, 0.0, best_region
+
+
+def find_card_number_region(image: Image.Image) -> Optional[tuple[int, int, int, int]]:
+    """(left, top, right, bottom) of the text line most likely to be the card
+    number, from row and column projection profiles of the ink mask.
+
+    Card numbers are usually the largest text on the card, so lines are
+    ranked by height squared times inked width; a line made of 3-5 similarly
+    sized groups (like "4539 1488 0343 6467") counts double.
+    """
+    mask = binarize_image(image)
+    best_score, best_region = 0.0, None
+
+    for top, bottom in ink_runs(mask.sum(axis=1)):
+        height = bottom - top
+        columns = ink_runs(mask[top:bottom].any(axis=0))
+
+        # Merge glyphs into word groups across gaps narrower than half the height
+        groups = [list(columns[0])]
+        for start, end in columns[1:]:
+            if start - groups[-1][1] >= max(2, height // 2):
+                groups.append([start, end])
+            else:
+                groups[-1][1] = end
+
+        widths = np.array([end - start for start, end in groups], dtype=np.float64)
+        score = height**2 * sum(end - start for start, end in columns)
+        if 3 <= len(groups) <= 5 and widths.std() < 0.25 * widths.mean():
+            score *= 2
+
+        if score > best_score:
+            best_score, best_region = score, (columns[0][0], top, columns[-1][1], bottom)
+
+    return best_region
+
+
+def crop_card_number_region(
+    image: Image.Image, region: Optional[tuple[int, int, int, int]] = None
+) -> tuple[np.ndarray, Optional[tuple[int, int, int, int]]]:
+    """Crop (and downscale) the likely card number line for OCR. Returns the
+    pixels and the padded box, or the whole image and None."""
+    region = region or find_card_number_region(image)
+    if region is None:
+        return np.asarray(image.convert("RGB")), None
+
+    left, top, right, bottom = region
+    margin = max(2, (bottom - top) // 2)
+    region = (
+        max(0, left - margin),
+        max(0, top - margin),
+        min(image.width, right + margin),
+        min(image.height, bottom + margin),
+    )
+
+    crop = image.convert("RGB").crop(region)
+    if crop.height > OCR_ROI_MAX_HEIGHT > 0:
+        scale = OCR_ROI_MAX_HEIGHT / crop.height
+        crop = crop.resize((max(1, round(crop.width * scale)), OCR_ROI_MAX_HEIGHT), Image.LANCZOS)
+
+    return np.asarray(crop), region
+
+
+def find_card_number(text_lines: list[str]) -> Optional[str]:
+    matches = card_number_pattern.findall(re.sub(r"[- ]+", "", "\n".join(text_lines)))
+    return matches[0] if matches else None
+
+
+def read_card_number(file_path: str) -> Dict[str, Any]:
+    with Image.open(file_path) as image:
+        number, confidence, region = recognize_card_number(image)
+        method = "template"
+
+        # Fall back to the deep-learning OCR when the templates are not
+        # confident, on the likely number band first and the full image last
+        if number is None:
+            method = "easyocr"
+            crop, region = crop_card_number_region(image, region)
+
+            with ocr_pool.reader() as reader:
+                number = find_card_number(reader.readtext(crop, detail=0))
+
+                if number is None and region is not None:
+                    region = None
+                    number = find_card_number(reader.readtext(file_path, detail=0))
+
+    return {"number": number, "method": method, "region": region}
+
+
+def extract_credit_card_number(source: str = None, destination: str = None):
+    if not source:
+        raise HTTPException(status_code=400, detail="Source file is required")
+
+    file_path: str = source
+    output_path: str = destination or file_rename(file_path, "-number.txt")
+
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="Image file not found")
+
+    result = read_card_number(file_path)
+    extracted_number = result["number"] or "No credit card number found"
+
+    ## hard to install pytesseract
+    # image = Image.open(file_path)
+    # extracted_text = pytesseract.image_to_string(image)
+
+    ## below not working because of sensity data
+    # base64_image = encode_image(file_path, "PNG")
+    # image_url = f"data:image/png;base64,{base64_image}"
+    #
+    # response = get_chat_completions(
+    #     [
+    #         {
+    #             "role": "system",
+    #             "content": "Extract the credit card number from the image.",
+    #         },
+    #         {
+    #             "role": "user",
+    #             "content": [{"type": "image_url", "image_url": {"url": image_url}}],
+    #         },
+    #     ]
+    # )
+    #
+    # extracted_number = response["content"].strip()
+
+    with open(output_path, "w") as f:
+        f.write(extracted_number)
+
+    return {
+        "message": "Credit card number extracted",
+        "method": result["method"],
+        "region": result["region"],
+        "source": file_path,
+        "destination": output_path,
+        "status": "success",
+    }
+
+
+# Bulk OCR: images are spread over worker processes that each keep a warm
+# reader, and results are streamed to a JSON Lines file as they complete
+image_extensions = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp")
+
+ocr_process_pool: Optional[ProcessPoolExecutor] = None
+ocr_process_pool_lock = threading.Lock()
+
+
+def init_ocr_worker():
+    # The template fast path needs no model, so a missing easyocr is not fatal
+    try:
+        ocr_pool.preload()
+
+    except ImportError as e:
+        logging.warning(f"OCR worker running without EasyOCR: {e}")
+
+
+def get_ocr_process_pool() -> ProcessPoolExecutor:
+    global ocr_process_pool
+
+    with ocr_process_pool_lock:
+        if ocr_process_pool is None:
+            ocr_process_pool = ProcessPoolExecutor(
+                max_workers=OCR_BULK_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_ocr_worker,
+            )
+
+        return ocr_process_pool
+
+
+def reset_ocr_process_pool(pool: ProcessPoolExecutor):
+    """Drop a pool broken by a dead worker; the next call starts a fresh one."""
+    global ocr_process_pool
+
+    with ocr_process_pool_lock:
+        if ocr_process_pool is pool:
+            ocr_process_pool = None
+
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def submit_ocr_batch(image_paths: list[str]) -> tuple[ProcessPoolExecutor, Dict[Any, str]]:
+    pool = get_ocr_process_pool()
+
+    try:
+        return pool, {pool.submit(ocr_bulk_worker, path): path for path in image_paths}
+
+    except BrokenProcessPool:
+        reset_ocr_process_pool(pool)
+        pool = get_ocr_process_pool()
+        return pool, {pool.submit(ocr_bulk_worker, path): path for path in image_paths}
+
+
+def shutdown_ocr_process_pool():
+    global ocr_process_pool
+
+    with ocr_process_pool_lock:
+        if ocr_process_pool is not None:
+            ocr_process_pool.shutdown(cancel_futures=True)
+            ocr_process_pool = None
+
+
+def ocr_error_record(file_path: str, error: str) -> Dict[str, Any]:
+    """A bulk OCR result line for an image without a number, with the same keys as any other."""
+    return {
+        "source": file_path,
+        "number": None,
+        "method": None,
+        "region": None,
+        "error": error,
+        "seconds": None,
+    }
+
+
+def ocr_bulk_worker(file_path: str) -> Dict[str, Any]:
+    started = time.perf_counter()
+
+    try:
+        result = {"source": file_path, **read_card_number(file_path), "error": None}
+
+    except Exception as e:
+        result = ocr_error_record(file_path, e.detail if hasattr(e, "detail") else str(e))
+
+    result["seconds"] = round(time.perf_counter() - started, 4)
+
+    return result
+
+
+def resolve_image_paths(source: Union[str, list[str]]) -> list[str]:
+    """Image files named by a directory, a glob pattern, or a list of either."""
+    paths = []
+
+    for entry in [source] if isinstance(source, str) else source:
+        if os.path.isdir(entry):
+            matches = [os.path.join(entry, name) for name in os.listdir(entry)]
+        elif glob.has_magic(entry):
+            matches = glob.glob(entry, recursive=True)
+        else:
+            matches = [entry]
+
+        paths.extend(
+            path
+            for path in sorted(matches)
+            if path.lower().endswith(image_extensions) or path == entry
+        )
+
+    return list(dict.fromkeys(paths))
+
+
+def extract_credit_card_numbers(
+    source: Union[str, list[str]] = None, destination: str = None
+) -> dict:
+    if not source:
+        raise HTTPException(status_code=400, detail="Source images are required")
+
+    image_paths = resolve_image_paths(source)
+
+    if not image_paths:
+        raise HTTPException(status_code=404, detail="No images found")
+
+    output_path: str = destination or os.path.join(
+        source if isinstance(source, str) and os.path.isdir(source) else DATA_DIR,
+        "credit-card-numbers.jsonl",
+    )
+
+    started = time.perf_counter()
+    failed = 0
+    pending = image_paths
+
+    with open(output_path, "w", encoding="utf-8") as out:
+
+        def write(result: Dict[str, Any]):
+            nonlocal failed
+            failed += bool(result.get("error")) or not result.get("number")
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+
+        # A dead worker breaks the whole pool and every pending future with it,
+        # so images without a result are resubmitted once to a fresh pool
+        for attempt in range(2):
+            pool, futures = submit_ocr_batch(pending)
+            crashed = set()
+
+            for future in as_completed(futures):
+                try:
+                    write(future.result())
+
+                except BrokenProcessPool:
+                    crashed.add(futures[future])
+
+                except Exception as e:
+                    write(ocr_error_record(futures[future], str(e)))
+
+            if not crashed:
+                break
+
+            logging.warning(f"OCR worker crashed, {len(crashed)} images without a result")
+            reset_ocr_process_pool(pool)
+            pending = [path for path in image_paths if path in crashed]
+
+        else:
+            for path in pending:
+                write(ocr_error_record(path, "OCR worker crashed"))
+
+    seconds = time.perf_counter() - started
+
+    return {
+        "message": "Credit card numbers extracted",
+        "images": len(image_paths),
+        "failed": failed,
+        "seconds": round(seconds, 3),
+        "images_per_second": round(len(image_paths) / seconds, 2) if seconds else None,
+        "destination": output_path,
+        "status": "success",
+    }
+
+
+@app.post("/ocr/bulk")
+def ocr_bulk(source: list[str] = Query(...), destination: Optional[str] = None) -> dict:
+    return extract_credit_card_numbers(source if len(source) > 1 else source[0], destination)
+
+
+# A9. Simillar Comments
+def normalize_rows(embeddings) -> np.ndarray:
+    vectors = np.array(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return vectors / norms
+
+
+def top_similar_pairs(
+    embeddings, top_k: int = 1, memory_mb: int = SIMILARITY_MEMORY_MB
+) -> list[tuple[int, int, float]]:
+    """Exact top-k most similar (i, j, score) pairs with i < j, best first.
+
+    Rows are normalized once and compared block by block, so a single
+    (block, n) similarity slice never exceeds memory_mb.
+    """
+    vectors = normalize_rows(embeddings)
+    n = len(vectors)
+
+    if n < 2 or top_k < 1:
+        return []
+
+    block = max(1, (memory_mb * 2**20) // (4 * n))
+    best: list[tuple[float, int, int]] = []
+
+    for start in range(0, n - 1, block):
+        stop = min(start + block, n)
+
+        # Only columns >= start can be partners with i < j for this block
+        sims = vectors[start:stop] @ vectors[start:].T
+        sims[np.tril_indices(stop - start)] = -np.inf
+
+        k = min(top_k, sims.size)
+        for idx in np.argpartition(sims, -k, axis=None)[-k:]:
+            score = float(sims.flat[idx])
+            if score == -np.inf:
+                continue
+
+            i, j = divmod(int(idx), sims.shape[1])
+            item = (score, start + i, start + j)
+
+            if len(best) < top_k:
+                heapq.heappush(best, item)
+            elif item > best[0]:
+                heapq.heapreplace(best, item)
+
+    return [(i, j, score) for score, i, j in sorted(best, reverse=True)]
+
+
+class EmbeddingStore:
+    """Persistent embedding cache for one model, keyed by sha256(text).
+
+    Vectors live in a contiguous float32 file that is memory-mapped for reads;
+    a SQLite index maps each hash to its row. Appends and compaction run in
+    IMMEDIATE transactions, so several uvicorn workers can share a store.
+    Compaction writes a new file generation, leaving open maps valid.
+    """
+
+    def __init__(self, directory: str, max_rows: int = EMBEDDING_STORE_MAX_ROWS):
+        self.directory = directory
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.maps: Dict[int, np.memmap] = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.conn = sqlite3.connect(
+            os.path.join(directory, "index.db"),
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors "
+            "(hash TEXT PRIMARY KEY, row INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS vectors_last_used ON vectors (last_used)"
+        )
+        self.conn.execute(
+            "INSERT OR IGNORE INTO meta (key, value) VALUES "
+            "('dim', 0), ('generation', 0), ('rows', 0)"
+        )
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def vector_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"vectors-{generation}.f32")
+
+    def read_meta(self) -> Dict[str, int]:
+        return dict(self.conn.execute("SELECT key, value FROM meta").fetchall())
+
+    def vectors(self, generation: int, dim: int, min_rows: int) -> np.memmap:
+        vectors = self.maps.get(generation)
+
+        if vectors is None or len(vectors) < min_rows:
+            rows = os.path.getsize(self.vector_path(generation)) // (dim * 4)
+            vectors = np.memmap(
+                self.vector_path(generation), dtype=np.float32, mode="r", shape=(rows, dim)
+            )
+            self.maps = {generation: vectors}
+
+        return vectors
+
+    def lookup(self, hashes: list[str]) -> Dict[str, np.ndarray]:
+        """Return {hash: vector} for the stored hashes. Vectors are read-only
+        views into the memory map, not copies."""
+        if not hashes:
+            return {}
+
+        for attempt in range(3):
+            with self.lock:
+                try:
+                    self.conn.execute("BEGIN")
+                    meta = self.read_meta()
+                    rows: Dict[str, int] = {}
+
+                    for i in range(0, len(hashes), 500):
+                        chunk = hashes[i : i + 500]
+                        rows.update(
+                            self.conn.execute(
+                                "SELECT hash, row FROM vectors WHERE hash IN "
+                                f"({','.join('?' * len(chunk))})",
+                                chunk,
+                            ).fetchall()
+                        )
 
-        prettier_result = subprocess.run(
-            prettier_cmd,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
+                    if not rows:
+                        return {}
 
-        if prettier_result.stderr:
-            raise HTTPException(status_code=500, detail=prettier_result.stderr.strip())
+                    # Map the file inside the read transaction, so a concurrent
+                    # compaction cannot swap generations underneath us
+                    vectors = self.vectors(meta["generation"], meta["dim"], max(rows.values()) + 1)
 
-        # Step 2: Verify Formatting & Fallback to remark-cli if needed
-        with open(file_path, "r", encoding="utf-8") as f:
-            formatted_content = f.read()
+                except FileNotFoundError:
+                    continue
 
-        # Check if formatting is incorrect (example heuristic)
-        if "  +" in formatted_content or formatted_content.count("\n") < 3:
-            # Fallback to remark-cli if Prettier messed up the structure
-            remark_cmd = ["npx", "remark", "--output", file_path]
-            subprocess.run(remark_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                finally:
+                    self.conn.execute("COMMIT")
 
-        return {"message": "File formatted successfully", "file": file_path, "status": "success"}
+                self.touch(list(rows))
 
-    except subprocess.CalledProcessError as e:
-        raise HTTPException(status_code=500, detail=f"Formatting Error: {e.stderr}")
+                return {h: vectors[row] for h, row in rows.items()}
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+        raise RuntimeError("Embedding store changed during lookup")
 
+    def touch(self, hashes: list[str]):
+        try:
+            now = time.time()
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i : i + 500]
+                self.conn.execute(
+                    "UPDATE vectors SET last_used = ? WHERE hash IN "
+                    f"({','.join('?' * len(chunk))})",
+                    [now, *chunk],
+                )
+
+        except sqlite3.OperationalError as e:
+            # Recency is best effort; another worker may hold the write lock
+            logging.warning(f"Embedding store touch skipped: {e}")
+
+    def add(self, hashes: list[str], embeddings: np.ndarray):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+
+            try:
+                meta = self.read_meta()
+                dim = meta["dim"] or embeddings.shape[1]
+
+                if embeddings.shape[1] != dim:
+                    raise ValueError(
+                        f"Embedding dimension {embeddings.shape[1]} does not match store ({dim})"
+                    )
+
+                existing = set()
+                for i in range(0, len(hashes), 500):
+                    chunk = hashes[i : i + 500]
+                    existing.update(
+                        h
+                        for (h,) in self.conn.execute(
+                            "SELECT hash FROM vectors WHERE hash IN "
+                            f"({','.join('?' * len(chunk))})",
+                            chunk,
+                        )
+                    )
+
+                new_rows: Dict[str, int] = {}
+                for i, h in enumerate(hashes):
+                    if h not in existing and h not in new_rows:
+                        new_rows[h] = i
+
+                row = meta["rows"]
+                with open(self.vector_path(meta["generation"]), "ab+") as f:
+                    # Truncate any tail left by an interrupted append
+                    f.truncate(row * dim * 4)
+                    f.write(embeddings[list(new_rows.values())].tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                now = time.time()
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO vectors (hash, row, last_used) VALUES (?, ?, ?)",
+                    [(h, row + n, now) for n, h in enumerate(new_rows)],
+                )
+                self.conn.execute(
+                    "UPDATE meta SET value = ? WHERE key = 'rows'", (row + len(new_rows),)
+                )
+                self.conn.execute("UPDATE meta SET value = ? WHERE key = 'dim'", (dim,))
+                self.conn.execute("COMMIT")
+
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+        self.evict()
+
+    def evict(self, max_rows: Optional[int] = None):
+        """Drop least recently used entries above max_rows and compact the
+        vector file once most of it is dead space."""
+        max_rows = self.max_rows if max_rows is None else max_rows
+
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM vectors WHERE hash IN "
+                "(SELECT hash FROM vectors ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (max_rows,),
+            )
+            live = self.conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+            rows = self.read_meta()["rows"]
+
+        if rows > 2 * live + 1024:
+            self.compact()
+
+    def compact(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+
+            try:
+                meta = self.read_meta()
+                generation, dim = meta["generation"], meta["dim"]
+                entries = self.conn.execute("SELECT hash, row FROM vectors ORDER BY row").fetchall()
 
-# A3. Count the number of week-days in the list of dates
-day_names = [
-    "Monday",
-    "Tuesday",
-    "Wednesday",
-    "Thursday",
-    "Friday",
-    "Saturday",
-    "Sunday",
-]
+                with open(self.vector_path(generation + 1), "wb") as f:
+                    if entries:
+                        vectors = self.vectors(generation, dim, entries[-1][1] + 1)
+                        for i in range(0, len(entries), 65536):
+                            rows = [row for _, row in entries[i : i + 65536]]
+                            f.write(np.asarray(vectors[rows]).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                self.conn.executemany(
+                    "UPDATE vectors SET row = ? WHERE hash = ?",
+                    [(n, h) for n, (h, _) in enumerate(entries)],
+                )
+                self.conn.execute("UPDATE meta SET value = ? WHERE key = 'rows'", (len(entries),))
+                self.conn.execute(
+                    "UPDATE meta SET value = ? WHERE key = 'generation'", (generation + 1,)
+                )
+                self.conn.execute("COMMIT")
+
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+            self.maps.clear()
+
+        # Readers elsewhere may still have the old generation mapped; on
+        # platforms that refuse to delete open files it is retried next time
+        for name in os.listdir(self.directory):
+            match = re.fullmatch(r"vectors-(\d+)\.f32", name)
+            if match and int(match.group(1)) <= generation:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
 
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            meta = self.read_meta()
+            live = self.conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
 
-def count_weekday(weekday: str, source: str = None, destination: str = None) -> dict:
-    weekday = normalize_weekday(weekday)
-    weekday_index = day_names.index(weekday)
+        return {**meta, "live": live, "max_rows": self.max_rows}
 
-    if not source:
-        raise HTTPException(status_code=400, detail="Source file is required")
 
-    file_path: str = source
-    output_path: str = destination or file_rename(file_path, f"-{weekday}.txt")
+embedding_stores: Dict[str, EmbeddingStore] = {}
+embedding_stores_lock = threading.Lock()
 
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="File not found")
 
-    with open(file_path, "r") as f:
-        dates = [parser.parse(line.strip()) for line in f if line.strip()]
+def get_embedding_store(model: str = AI_EMBEDDINGS_MODEL) -> EmbeddingStore:
+    with embedding_stores_lock:
+        if model not in embedding_stores:
+            directory = os.path.join(EMBEDDING_STORE_DIR, re.sub(r"[^\w.-]+", "_", model))
+            embedding_stores[model] = EmbeddingStore(directory)
 
-    day_count = sum(1 for d in dates if d.weekday() == weekday_index)
+        return embedding_stores[model]
 
-    with open(output_path, "w") as f:
-        f.write(str(day_count))
 
-    return {
-        "message": f"{weekday} counted",
-        "count": day_count,
-        "source": file_path,
-        "destination": output_path,
-        "status": "success",
-    }
+def get_embeddings_cached(texts: list[str]) -> np.ndarray:
+    """Embeddings for texts as an (n, dim) float32 matrix; only texts missing
+    from the embedding store are sent to the API."""
+    store = get_embedding_store()
+    hashes = [store.text_hash(text) for text in texts]
+    found = store.lookup(list(dict.fromkeys(hashes)))
 
+    missing = {h: text for h, text in zip(hashes, texts) if h not in found}
+    if missing:
+        fetched = np.asarray(get_embeddings(list(missing.values())), dtype=np.float32)
+        store.add(list(missing), fetched)
+        found.update(zip(missing, fetched))
 
-def normalize_weekday(weekday):
-    if isinstance(weekday, int):  # If input is an integer (0-6)
-        return day_names[weekday % 7]
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
 
-    elif isinstance(weekday, str):  # If input is a string
-        weekday = weekday.strip().lower()
-        days = {day.lower(): day for day in day_names}
-        short_days = {day[:3].lower(): day for day in day_names}
+    return np.stack([found[h] for h in hashes])
 
-        if weekday in days:
-            return days[weekday]
 
-        elif weekday in short_days:
-            return short_days[weekday]
+class LshIndex:
+    """Random-projection LSH over text hashes, built incrementally.
 
-    raise ValueError("Invalid weekday input")
+    Each of the tables hashes a vector to the sign pattern of its projection
+    on random hyperplanes; vectors that share a bucket in any table are
+    candidate neighbours.
+    """
 
+    def __init__(self, dim: int, tables: int = ANN_TABLES, bits: int = ANN_BITS, seed: int = ANN_SEED):
+        rng = np.random.default_rng(seed)
+        self.planes = rng.standard_normal((tables, dim, bits)).astype(np.float32)
+        self.hashes: list[str] = []
+        self.codes = np.empty((0, tables), dtype=np.int64)
+        self.positions: Dict[str, int] = {}
 
-# A4. Sort the array of contacts by last name and first name
-import json
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        return self.planes.shape
 
-def sort_contacts(order: str, source: Optional[str], destination: Optional[str]):
-    logger.info(f"Sorting contacts from {source}, order: {order}, writing to {destination}")
+    def hash_vectors(self, vectors: np.ndarray) -> np.ndarray:
+        bits = np.einsum("nd,tdb->ntb", vectors, self.planes) > 0
+        weights = np.left_shift(1, np.arange(self.planes.shape[2], dtype=np.int64))
 
-    if not source or not os.path.exists(source):
-        raise HTTPException(status_code=400, detail="Source file not found")
+        return bits.astype(np.int64) @ weights
 
-    if not destination:
-        raise HTTPException(status_code=400, detail="Destination file not provided")
+    def add(self, hashes: list[str], vectors: np.ndarray) -> int:
+        new = [n for n, h in enumerate(hashes) if h not in self.positions]
+        new = list({hashes[n]: n for n in new}.values())
 
-    try:
-        with open(source, "r") as f:
-            contacts = json.load(f)
+        if new:
+            self.codes = np.concatenate([self.codes, self.hash_vectors(vectors[new])])
+            for n in new:
+                self.positions[hashes[n]] = len(self.hashes)
+                self.hashes.append(hashes[n])
 
-        key = "last_name" if order == "last_name" else "first_name"
-        sorted_contacts = sorted(contacts, key=lambda x: x.get(key, "").lower())
+        return len(new)
 
-        with open(destination, "w") as f:
-            json.dump(sorted_contacts, f, indent=4)
+    def codes_for(self, hashes: list[str]) -> np.ndarray:
+        return self.codes[[self.positions[h] for h in hashes]]
 
-        logger.info(f"Sorted contacts written successfully to {destination}")
-        return {"message": "Contacts sorted successfully"}
+    def save(self, path: str):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, planes=self.planes, codes=self.codes, hashes=np.array(self.hashes))
+        os.replace(tmp_path, path)
 
-    except Exception as e:
-        logger.error(f"Error sorting contacts: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    @classmethod
+    def load(cls, path: str) -> "LshIndex":
+        with np.load(path) as data:
+            tables, dim, bits = data["planes"].shape
+            index = cls(dim, tables, bits)
+            index.planes = data["planes"]
+            index.codes = data["codes"]
+            index.hashes = [str(h) for h in data["hashes"]]
 
-# A5. Write the first line of the 10 most recent .log file in /data/logs/ to /data/logs-recent.txt, most recent first
-def write_recent_logs(count: int, source: str = None, destination: str = None):
-    if count < 1:
-        raise HTTPException(status_code=400, detail="Invalid count")
+        index.positions = {h: n for n, h in enumerate(index.hashes)}
 
-    if not source:
-        raise HTTPException(status_code=400, detail="Source file is required")
+        return index
 
-    file_path: str = source
-    file_dir: str = os.path.dirname(file_path)
-    output_path: str = destination or os.path.join(DATA_DIR, f"{file_dir}-recent.txt")
 
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="File not found")
+def open_lsh_index(path: str, dim: int, tables: int = ANN_TABLES, bits: int = ANN_BITS) -> LshIndex:
+    if os.path.exists(path):
+        try:
+            index = LshIndex.load(path)
+            if index.shape == (tables, dim, bits):
+                return index
 
-    log_files = sorted(
-        [
-            os.path.join(file_path, f)
-            for f in os.listdir(file_path)
-            if f.endswith(".log")
-        ],
-        key=os.path.getmtime,
-        reverse=True,
-    )
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Rebuilding ANN index {path}: {e}")
 
-    with open(output_path, "w") as out:
-        for log_file in log_files[:count]:
-            with open(log_file, "r") as f:
-                first_line = f.readline().strip()
-                out.write(f"{first_line}\n")
+    return LshIndex(dim, tables, bits)
 
-    return {
-        "message": "Recent logs written",
-        "log_dir": file_path,
-        "output_file": output_path,
-        "status": "success",
-    }
 
+def approximate_similar_pairs(
+    embeddings, codes: np.ndarray, top_k: int = 1, memory_mb: int = SIMILARITY_MEMORY_MB
+) -> list[tuple[int, int, float]]:
+    """Top-k pairs among vectors that share an LSH bucket in any table,
+    re-ranked by exact cosine similarity."""
+    vectors = normalize_rows(embeddings)
+    best: Dict[tuple[int, int], float] = {}
 
-# A6. Index for Markdown (.md) files in /data/docs/
-def extract_markdown_titles(source: str = None, destination: str = None):
-    if not source:
-        raise HTTPException(status_code=400, detail="Source file is required")
+    def keep(i: int, j: int, score: float):
+        best[(min(i, j), max(i, j))] = score
 
-    file_path: str = source
-    output_path: str = destination or os.path.join(file_path, "index.json")
+    for table in range(codes.shape[1]):
+        order = np.argsort(codes[:, table], kind="stable")
+        buckets = np.split(order, np.flatnonzero(np.diff(codes[order, table])) + 1)
 
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Directory not found")
+        # Buckets of the same size are scored together as one batched matmul
+        by_size: Dict[int, list] = {}
+        for members in buckets:
+            if len(members) > 1:
+                by_size.setdefault(len(members), []).append(members)
 
-    index = {}
-    collect_markdown_titles(file_path, index)
+        for size, groups in by_size.items():
+            if size > 256:
+                for members in groups:
+                    for i, j, score in top_similar_pairs(vectors[members], top_k, memory_mb):
+                        keep(int(members[i]), int(members[j]), score)
+                continue
 
-    with open(output_path, "w") as f:
-        json.dump(index, f, indent=4)
+            step = max(1, (memory_mb * 2**20) // (4 * size * size))
+            mask = np.tril(np.ones((size, size), dtype=bool))
 
-    return {
-        "message": "Markdown titles extracted",
-        "file_dir": file_path,
-        "index_file": output_path,
-        "status": "success",
-    }
+            for n in range(0, len(groups), step):
+                members = np.stack(groups[n : n + step])
+                block = vectors[members]
+                sims = block @ block.transpose(0, 2, 1)
+                sims[:, mask] = -np.inf
 
+                k = min(top_k, sims.size)
+                for idx in np.argpartition(sims, -k, axis=None)[-k:]:
+                    g, i, j = np.unravel_index(idx, sims.shape)
+                    if sims[g, i, j] > -np.inf:
+                        keep(int(members[g, i]), int(members[g, j]), float(sims[g, i, j]))
 
-def collect_markdown_titles(directory: str, index: dict):
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith(".md"):
-                file_path = os.path.join(root, file)
-                with open(file_path, "r") as f:
-                    title = None
-                    for line in f:
-                        if line.startswith("# "):
-                            title = line[2:].strip()
-                            break
+    pairs = heapq.nlargest(top_k, best.items(), key=lambda item: item[1])
 
-                    if title:
-                        relative_path = os.path.relpath(file_path, directory)
-                        relative_path = re.sub(r"[\\/]+", "/", relative_path)
-                        index[relative_path] = title
+    return [(i, j, score) for (i, j), score in pairs]
 
 
-# A7. Extract the sender's email address from an email message
-def extract_email_sender(source: str = None, destination: str = None):
+def similar_comments(
+    source: str = None, destination: str = None, top_k: int = 1, mode: str = "exact"
+):
     if not source:
         raise HTTPException(status_code=400, detail="Source file is required")
 
     file_path: str = source
-    output_path: str = destination or file_rename(file_path, "-sender.txt")
+    output_path: str = destination or file_rename(file_path, "-similar.txt")
 
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
 
-    with open(file_path, "r") as f:
-        email_content = f.read()
+    # Load comments
+    comments = read_lines(file_path)
 
-    response = get_chat_completions(
-        [
-            {"role": "system", "content": "Extract the sender's email."},
-            {"role": "user", "content": email_content},
-        ]
-    )
+    # Compute embeddings in batched, concurrent requests, reusing stored ones
+    embeddings = get_embeddings_cached(comments)
 
-    extracted_email = response["content"].strip()
+    # Find the most similar pairs
+    pairs = []
 
-    with open(output_path, "w") as f:
-        f.write(extracted_email)
+    if mode == "ann" and len(comments) > 1:
+        # The LSH index is kept next to the source and only grows with new comments
+        index_path = f"{file_path}.ann.npz"
+        index = open_lsh_index(index_path, embeddings.shape[1])
+        hashes = [EmbeddingStore.text_hash(comment) for comment in comments]
+
+        if index.add(hashes, embeddings):
+            index.save(index_path)
+
+        pairs = approximate_similar_pairs(embeddings, index.codes_for(hashes), max(1, top_k))
+
+    if not pairs:
+        pairs = top_similar_pairs(embeddings, max(1, top_k))
+
+    if not pairs:
+        raise HTTPException(status_code=400, detail="At least two comments are required")
+
+    # Write the most similar pair to output file
+    i, j, _ = pairs[0]
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write("\n".join((comments[i], comments[j])))
 
     return {
-        "message": "Email extracted",
+        "message": "Similar comments extracted",
         "source": file_path,
         "destination": output_path,
+        "pairs": [
+            {"comments": [comments[i], comments[j]], "score": score}
+            for i, j, score in pairs
+        ],
         "status": "success",
     }
 
 
-# A8. Extract credit card number.
-def encode_image(image_path: str, format: str):
-    image = Image.open(image_path)
+# A10
+class SqlitePool:
+    """Read-only connections to one SQLite database, handed out one query at a
+    time, plus an LRU of query results keyed on the database file fingerprint
+    so that any committed write (to the database or its WAL) invalidates them."""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = max(1, size)
+        self.connections: queue.Queue = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.results: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def create_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute(f"PRAGMA cache_size = {-SQLITE_CACHE_KIB}")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_BYTES}")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self.connections.get_nowait()
 
-    buffer = BytesIO()
-    image.save(buffer, format=format)
-    image_bytes = buffer.getvalue()
+        except queue.Empty:
+            pass
 
-    base64_image = base64.b64encode(image_bytes).decode("utf-8")
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
 
-    return base64_image
+        if create:
+            try:
+                return self.create_connection()
 
+            except BaseException:
+                with self.lock:
+                    self.created -= 1
+                raise
 
-def extract_credit_card_number(source: str = None, destination: str = None):
-    if not source:
-        raise HTTPException(status_code=400, detail="Source file is required")
+        try:
+            return self.connections.get(timeout=SQLITE_ACQUIRE_TIMEOUT)
 
-    file_path: str = source
-    output_path: str = destination or file_rename(file_path, "-number.txt")
+        except queue.Empty:
+            raise HTTPException(status_code=503, detail="Database connections are busy, try again")
 
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Image file not found")
-    import easyocr
-    # Taking more time
-    reader = easyocr.Reader(["en"])
-    results = reader.readtext(file_path, detail=0)
-
-    extracted_text = "\n".join(results)
-    extracted_text = re.sub(r"[- ]+", "", extracted_text)
-    matches = re.findall(
-        r"\b(?:4\d{12}(?:\d{3})?|5[1-5]\d{14}|3[47]\d{13}|6(?:011|5\d{2})\d{12}|3(?:0[0-5]|[68]\d)\d{11}|(?:2131|1800|35\d{3})\d{11})\b",
-        extracted_text,
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    def fingerprint(self) -> tuple:
+        stats = []
+        for path in (self.path, f"{self.path}-wal"):
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                stats.append(None)
+
+        return tuple(stats)
+
+    def query(self, sql: str, params: tuple = ()) -> tuple[list, list[str], bool]:
+        """Rows and column names of a read-only query, and whether they were cached."""
+        key = (sql, params)
+        fingerprint = self.fingerprint()
+
+        with self.lock:
+            cached = self.results.get(key)
+            if cached and cached[0] == fingerprint:
+                self.results.move_to_end(key)
+                self.hits += 1
+                return cached[1], cached[2], True
+
+            self.misses += 1
+
+        with self.connection() as conn:
+            cursor = conn.execute(sql, params)
+            rows = cursor.fetchall()
+            columns = [column[0] for column in cursor.description or []]
+
+        with self.lock:
+            self.results[key] = (fingerprint, rows, columns)
+            self.results.move_to_end(key)
+            while len(self.results) > SQLITE_RESULT_CACHE_SIZE:
+                self.results.popitem(last=False)
+
+        return rows, columns, False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connections": self.created,
+            "results": len(self.results),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+sqlite_pools: Dict[str, SqlitePool] = {}
+sqlite_pools_lock = threading.Lock()
+sqlite_indexed: set = set()
+
+
+def get_sqlite_pool(path: str) -> SqlitePool:
+    path = os.path.abspath(path)
+
+    with sqlite_pools_lock:
+        pool = sqlite_pools.get(path)
+        if pool is None:
+            pool = sqlite_pools[path] = SqlitePool(path, SQLITE_POOL_SIZE)
+
+    return pool
+
+
+def close_sqlite_pools():
+    with sqlite_pools_lock:
+        while sqlite_pools:
+            sqlite_pools.popitem()[1].close()
+
+
+def ensure_sqlite_index(path: str, table: str, columns: list[str]):
+    """
+    Create a helper index on the filter columns of a query, once per process.
+    A column may carry a collation ("type COLLATE NOCASE"). Read-only
+    databases are left alone and simply scanned.
+    """
+    key = (os.path.abspath(path), table, tuple(columns))
+    if not SQLITE_AUTO_INDEX or key in sqlite_indexed or not os.access(path, os.W_OK):
+        return
+
+    sqlite_indexed.add(key)
+    spec = [
+        (words[0], words[2].upper() if len(words) == 3 and words[1].upper() == "COLLATE" else "BINARY")
+        for words in (column.split() for column in columns)
+    ]
+    name = "_".join(
+        ["idx", table]
+        + [column if collation == "BINARY" else f"{column}_{collation.lower()}" for column, collation in spec]
     )
 
-    extracted_number = (
-        matches[0] if (matches and len(matches) > 0) else "No credit card number found"
+    try:
+        conn = sqlite3.connect(path, timeout=5)
+        try:
+            existing = {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+            if not existing or not {column for column, _ in spec} <= existing:
+                return
+
+            # Any index (primary keys included) already leading with these columns will do
+            for index in conn.execute(f'PRAGMA index_list("{table}")').fetchall():
+                indexed = [
+                    (row[2], row[4].upper())
+                    for row in conn.execute(f'PRAGMA index_xinfo("{index[1]}")')
+                    if row[5]
+                ]
+                if indexed[: len(spec)] == spec:
+                    return
+
+            with conn:
+                conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ('
+                    + ", ".join(f'"{column}" COLLATE {collation}' for column, collation in spec)
+                    + ")"
+                )
+        finally:
+            conn.close()
+
+    except sqlite3.Error as e:
+        logging.warning(f"Index {name} not created on {path}: {e}")
+
+
+def sqlite_filter_columns(sql: str) -> Optional[tuple[str, list[str]]]:
+    """Table and equality/IN filter columns of a simple single-table SELECT."""
+    if re.search(r"\bJOIN\b", sql, re.IGNORECASE):
+        return None
+
+    match = re.search(
+        r"\bFROM\s+\"?(\w+)\"?\s+WHERE\s+(.*?)(?:\bGROUP\b|\bORDER\b|\bLIMIT\b|$)",
+        sql,
+        re.IGNORECASE | re.DOTALL,
     )
+    if not match or match.group(1).lower().startswith("sqlite_"):
+        return None
 
-    ## hard to install pytesseract
-    # image = Image.open(file_path)
-    # extracted_text = pytesseract.image_to_string(image)
+    columns = re.findall(r"\"?(\w+)\"?\s*(?:=|\bIN\b)", match.group(2), re.IGNORECASE)
+    return (match.group(1), list(dict.fromkeys(columns))) if columns else None
 
-    ## below not working because of sensity data
-    # base64_image = encode_image(file_path, "PNG")
-    # image_url = f"data:image/png;base64,{base64_image}"
-    #
-    # response = get_chat_completions(
-    #     [
-    #         {
-    #             "role": "system",
-    #             "content": "Extract the credit card number from the image.",
-    #         },
-    #         {
-    #             "role": "user",
-    #             "content": [{"type": "image_url", "image_url": {"url": image_url}}],
-    #         },
-    #     ]
-    # )
-    #
-    # extracted_number = response["content"].strip()
+
+def check_select_query(sql: str) -> str:
+    """
+    The single SELECT statement in `sql`, without its trailing semicolon.
+    sqlite3.complete_statement tells a statement-ending semicolon from one
+    inside a string literal, quoted identifier or comment.
+    """
+    if not re.match(r"\s*(?:SELECT|WITH)\b", sql, re.IGNORECASE):
+        raise HTTPException(status_code=400, detail="Only a single SELECT query is allowed")
+
+    for n, char in enumerate(sql):
+        if char == ";" and sqlite3.complete_statement(sql[: n + 1]):
+            if sql[n + 1 :].strip(" \t\r\n;"):
+                raise HTTPException(status_code=400, detail="Only a single SELECT query is allowed")
+            return sql[:n]
+
+    return sql
+
+
+def run_sqlite_query(
+    path: str, sql: str, params: tuple = (), index: Optional[tuple[str, list[str]]] = None
+) -> tuple[list, list[str], bool]:
+    check_select_query(sql)
+
+    filters = index or sqlite_filter_columns(sql)
+    if filters:
+        ensure_sqlite_index(path, *filters)
+
+    try:
+        return get_sqlite_pool(path).query(sql, params)
+
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=400, detail=f"Query failed: {e}")
+
+
+def query_database(
+    query: str, params: Optional[list] = None, source: str = None, destination: str = None
+):
+    if not query:
+        raise HTTPException(status_code=400, detail="Query is required")
+
+    db_path: str = source or os.path.join(DATA_DIR, "ticket-sales.db")
+    output_path: str = destination or os.path.join(DATA_DIR, "query-result.txt")
+
+    if not os.path.exists(db_path):
+        raise HTTPException(status_code=404, detail="Database not found")
+
+    rows, columns, cached = run_sqlite_query(db_path, query, tuple(params or ()))
+
+    # A single aggregate is written as a bare value, anything else as JSON rows
+    if len(rows) == 1 and len(columns) == 1:
+        result = rows[0][0]
+        text = str(result)
+    else:
+        result = [dict(zip(columns, row)) for row in rows]
+        text = json.dumps(result, indent=4)
 
     with open(output_path, "w") as f:
-        f.write(extracted_number)
+        f.write(text)
 
     return {
-        "message": "Credit card number extracted",
-        "source": file_path,
-        "destination": output_path,
+        "message": "Query executed",
+        "output_file": output_path,
+        "result": result,
+        "cached": cached,
         "status": "success",
     }
 
 
-# A9. Simillar Comments
-def cosine_similarity(vec1, vec2):
-    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
+def export_query(
+    query: str,
+    params: Optional[list] = None,
+    source: str = None,
+    destination: str = None,
+    format: Optional[str] = None,
+    limit: Optional[int] = None,
+):
+    if not query:
+        raise HTTPException(status_code=400, detail="Query is required")
 
+    db_path: str = source or os.path.join(DATA_DIR, "ticket-sales.db")
+    output_path: str = destination or os.path.join(DATA_DIR, "query-result.csv")
+    format = (format or os.path.splitext(output_path)[1].lstrip(".") or "csv").lower()
 
-def similar_comments(source: str = None, destination: str = None):
-    if not source:
-        raise HTTPException(status_code=400, detail="Source file is required")
+    if format == "ndjson":
+        format = "jsonl"
 
-    file_path: str = source
-    output_path: str = destination or file_rename(file_path, "-similar.txt")
+    if format not in ("csv", "jsonl", "json"):
+        raise HTTPException(status_code=400, detail="Format must be csv, jsonl or json")
 
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="File not found")
+    if limit is not None and limit < 0:
+        raise HTTPException(status_code=400, detail="Invalid limit")
 
-    # Load comments
-    with open(file_path, "r", encoding="utf-8") as f:
-        comments = [line.strip() for line in f.readlines()]
+    if not os.path.exists(db_path):
+        raise HTTPException(status_code=404, detail="Database not found")
 
-    # Compute embeddings
-    embeddings = [get_embeddings(comment) for comment in comments]
+    sql = check_select_query(query).strip()
+    params = tuple(params or ())
 
-    # Find the most similar pair
-    max_sim = -1
-    most_similar_pair = (None, None)
+    # Push the limit into the query so SQLite stops producing rows early
+    if limit is not None:
+        sql = f"SELECT * FROM ({sql}\n) LIMIT ?"
+        params += (limit,)
 
-    for i in range(len(comments)):
-        for j in range(i + 1, len(comments)):
-            sim = cosine_similarity(embeddings[i], embeddings[j])
-            if sim > max_sim:
-                max_sim = sim
-                most_similar_pair = (comments[i], comments[j])
+    started = time.perf_counter()
+    rows = 0
+    fd, tmp_path = tempfile.mkstemp(
+        suffix=".tmp", prefix=".export-", dir=os.path.dirname(os.path.abspath(output_path))
+    )
 
-    # Write the most similar pair to output file
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(most_similar_pair))
+    try:
+        # A long export gets its own read-only connection instead of holding a
+        # pooled one that short aggregation queries are waiting for
+        with closing(get_sqlite_pool(db_path).create_connection()) as conn, open(
+            fd, "w", newline="", encoding="utf-8"
+        ) as f:
+            cursor = conn.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+
+            if format == "csv":
+                writer = csv.writer(f)
+                writer.writerow(columns)
+            elif format == "json":
+                f.write("[")
+
+            while True:
+                batch = cursor.fetchmany(SQLITE_EXPORT_BATCH)
+                if not batch:
+                    break
+
+                if format == "csv":
+                    writer.writerows(batch)
+                elif format == "json":
+                    # A streamed JSON array: every row but the very first is preceded by a comma
+                    f.writelines(
+                        ("\n" if rows == 0 and n == 0 else ",\n")
+                        + json.dumps(dict(zip(columns, row)), default=bytes.hex)
+                        for n, row in enumerate(batch)
+                    )
+                else:
+                    f.writelines(
+                        json.dumps(dict(zip(columns, row)), default=bytes.hex) + "\n"
+                        for row in batch
+                    )
+
+                rows += len(batch)
+
+            cursor.close()
+
+            if format == "json":
+                f.write("\n]\n" if rows else "]\n")
+
+        # mkstemp files are private; exports get the usual permissions
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, output_path)
+
+    except sqlite3.Error as e:
+        os.unlink(tmp_path)
+        raise HTTPException(status_code=400, detail=f"Query failed: {e}")
+
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    seconds = time.perf_counter() - started
 
     return {
-        "message": "Similar comments extracted",
-        "source": file_path,
-        "destination": output_path,
+        "message": "Query exported",
+        "output_file": output_path,
+        "format": format,
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds, 1) if seconds else None,
         "status": "success",
     }
 
 
-# A10
-def calculate_ticket_sales(task):
-    db_path = os.path.join(DATA_DIR, "ticket-sales.db")
-    output_path = os.path.join(DATA_DIR, "ticket-sales-gold.txt")
+@app.get("/sqlite-pools")
+def sqlite_pool_stats() -> Dict[str, Any]:
+    return {path: pool.stats() for path, pool in sqlite_pools.items()}
+
+
+def calculate_ticket_sales(
+    ticket_type: str = "Gold",
+    source: str = None,
+    destination: str = None,
+    summary: Optional[bool] = None,
+):
+    if not ticket_type:
+        raise HTTPException(status_code=400, detail="Ticket type is required")
+
+    db_path: str = source or os.path.join(DATA_DIR, "ticket-sales.db")
+    output_path: str = destination or os.path.join(
+        DATA_DIR, f"ticket-sales-{ticket_type.lower()}.txt"
+    )
+
+    if not os.path.exists(db_path):
+        raise HTTPException(status_code=404, detail="Database not found")
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    summarized = (TICKET_TOTALS if summary is None else summary) and has_ticket_totals(db_path)
 
-    cursor.execute("SELECT SUM(units * price) FROM tickets WHERE type = 'Gold'")
-    total_sales = cursor.fetchone()[0] or 0
+    if summarized:
+        rows, _, cached = run_sqlite_query(
+            db_path,
+            "SELECT SUM(revenue) FROM ticket_totals WHERE type = ? COLLATE NOCASE",
+            (ticket_type,),
+        )
+        total_sales = rows[0][0] or 0
 
-    conn.close()
+    else:
+        # Ticket types match case-insensitively ("gold" is Gold), and a covering
+        # index with the same collation turns the sum into a range scan
+        rows, _, cached = run_sqlite_query(
+            db_path,
+            "SELECT SUM(units * price) FROM tickets WHERE type = ? COLLATE NOCASE",
+            (ticket_type,),
+            index=("tickets", ["type COLLATE NOCASE", "units", "price"]),
+        )
+        total_sales = rows[0][0] or 0
 
     with open(output_path, "w") as f:
         f.write(str(total_sales))
 
     return {
         "message": "Sales calculated",
+        "ticket_type": ticket_type,
         "total_sales": total_sales,
+        "summary": bool(summarized),
+        "cached": cached,
+        "status": "success",
+    }
+
+
+# Per-type totals kept current by triggers on tickets, so a ticket type's
+# sales are a primary key lookup however large the table grows
+ticket_totals_schema = """
+CREATE TABLE IF NOT EXISTS ticket_totals (
+    type TEXT PRIMARY KEY,
+    units INTEGER NOT NULL,
+    revenue REAL NOT NULL,
+    rows INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS ticket_totals_insert AFTER INSERT ON tickets
+WHEN NEW.type IS NOT NULL
+BEGIN
+    INSERT INTO ticket_totals VALUES (NEW.type, NEW.units, NEW.units * NEW.price, 1)
+    ON CONFLICT (type) DO UPDATE SET
+        units = units + excluded.units,
+        revenue = revenue + excluded.revenue,
+        rows = rows + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS ticket_totals_delete AFTER DELETE ON tickets
+WHEN OLD.type IS NOT NULL
+BEGIN
+    UPDATE ticket_totals SET
+        units = units - OLD.units,
+        revenue = revenue - OLD.units * OLD.price,
+        rows = rows - 1
+    WHERE type = OLD.type;
+    DELETE FROM ticket_totals WHERE type = OLD.type AND rows <= 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS ticket_totals_update AFTER UPDATE OF type, units, price ON tickets
+BEGIN
+    UPDATE ticket_totals SET
+        units = units - OLD.units,
+        revenue = revenue - OLD.units * OLD.price,
+        rows = rows - 1
+    WHERE type = OLD.type;
+    DELETE FROM ticket_totals WHERE type = OLD.type AND rows <= 0;
+    INSERT INTO ticket_totals SELECT NEW.type, NEW.units, NEW.units * NEW.price, 1
+    WHERE NEW.type IS NOT NULL
+    ON CONFLICT (type) DO UPDATE SET
+        units = units + excluded.units,
+        revenue = revenue + excluded.revenue,
+        rows = rows + 1;
+END;
+"""
+
+ticket_totals_objects = (
+    ("trigger", "ticket_totals_insert"),
+    ("trigger", "ticket_totals_delete"),
+    ("trigger", "ticket_totals_update"),
+    ("table", "ticket_totals"),
+)
+
+
+def has_ticket_totals(db_path: str) -> bool:
+    rows, _, _ = run_sqlite_query(
+        db_path,
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'ticket_totals_%'",
+    )
+    return rows[0][0] == 3
+
+
+def install_ticket_totals(db_path: str) -> int:
+    """Create the summary table and triggers, and backfill it from tickets."""
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        # Writers are held off until the backfill matches what the triggers will see
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in ticket_totals_schema.split(";\n\n"):
+                conn.execute(statement)
+
+            conn.execute("DELETE FROM ticket_totals")
+            conn.execute(
+                """
+                INSERT INTO ticket_totals
+                SELECT type, SUM(units), SUM(units * price), COUNT(*)
+                FROM tickets WHERE type IS NOT NULL GROUP BY type
+                """
+            )
+            types = conn.execute("SELECT COUNT(*) FROM ticket_totals").fetchone()[0]
+            conn.execute("COMMIT")
+
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    finally:
+        conn.close()
+
+    return types
+
+
+def drop_ticket_totals(db_path: str):
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        with conn:
+            for kind, name in ticket_totals_objects:
+                conn.execute(f"DROP {kind.upper()} IF EXISTS {name}")
+    finally:
+        conn.close()
+
+
+def verify_ticket_totals(db_path: str, tolerance: float = 0.01) -> list[Dict[str, Any]]:
+    """Per-type differences between ticket_totals and a full scan of tickets."""
+    with get_sqlite_pool(db_path).connection() as conn:
+        conn.execute("BEGIN")
+        try:
+            summary = {
+                row[0]: row[1:]
+                for row in conn.execute("SELECT type, units, revenue, rows FROM ticket_totals")
+            }
+            scanned = {
+                row[0]: row[1:]
+                for row in conn.execute(
+                    """
+                    SELECT type, SUM(units), SUM(units * price), COUNT(*)
+                    FROM tickets WHERE type IS NOT NULL GROUP BY type
+                    """
+                )
+            }
+        finally:
+            conn.execute("COMMIT")
+
+    mismatches = []
+    for ticket_type in sorted(summary.keys() | scanned.keys()):
+        expected = scanned.get(ticket_type, (0, 0.0, 0))
+        actual = summary.get(ticket_type, (0, 0.0, 0))
+
+        if (
+            expected[0] != actual[0]
+            or expected[2] != actual[2]
+            or abs(expected[1] - actual[1]) > tolerance
+        ):
+            mismatches.append(
+                {
+                    "type": ticket_type,
+                    "expected": dict(zip(("units", "revenue", "rows"), expected)),
+                    "actual": dict(zip(("units", "revenue", "rows"), actual)),
+                }
+            )
+
+    return mismatches
+
+
+@app.post("/ticket-totals")
+def ticket_totals(action: str = "install", source: str = None) -> Dict[str, Any]:
+    db_path: str = source or os.path.join(DATA_DIR, "ticket-sales.db")
+
+    if action not in ("install", "backfill", "verify", "drop"):
+        raise HTTPException(status_code=400, detail="Action must be install, backfill, verify or drop")
+
+    if not os.path.exists(db_path):
+        raise HTTPException(status_code=404, detail="Database not found")
+
+    if action != "verify" and not os.access(db_path, os.W_OK):
+        raise HTTPException(status_code=403, detail="Database is read-only")
+
+    if action == "verify":
+        if not has_ticket_totals(db_path):
+            raise HTTPException(status_code=409, detail="ticket_totals is not installed")
+
+        mismatches = verify_ticket_totals(db_path)
+        return {
+            "message": "Ticket totals verified",
+            "consistent": not mismatches,
+            "mismatches": mismatches,
+            "status": "success",
+        }
+
+    try:
+        if action == "drop":
+            drop_ticket_totals(db_path)
+            return {"message": "Ticket totals dropped", "status": "success"}
+
+        # Installing is idempotent, so a backfill is the same operation
+        types = install_ticket_totals(db_path)
+
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=400, detail=f"Ticket totals failed: {e}")
+
+    return {
+        "message": "Ticket totals backfilled" if action == "backfill" else "Ticket totals installed",
+        "types": types,
         "status": "success",
     }
 
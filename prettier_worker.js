@@ -0,0 +1,74 @@
+// Long-lived prettier formatter for main.py's format_file.
+//
+// Protocol: one JSON object per line on stdin, one JSON reply per line on stdout.
+//   request:  {"id": 1, "text": "...", "options": {"parser": "markdown", "filepath": "...", ...}}
+//   reply:    {"id": 1, "ok": true, "text": "..."}
+//             {"id": 1, "ok": false, "error": "..."}
+//   request:  {"id": 2, "resolveConfig": "/path/to/file.md"}
+//   reply:    {"id": 2, "ok": true, "config": {...} or null}
+// Like the prettier CLI, files are formatted with the .prettierrc/.editorconfig
+// settings that apply to options.filepath, overridden by the explicit options.
+// A format request with "resolved": true already carries those settings in its
+// options, and is formatted without looking up the config files again.
+// On startup the worker writes {"ready": true, "version": "..."} once prettier
+// is loaded, or {"ready": false, "error": "..."} and exits if it cannot be.
+
+const readline = require("readline");
+const path = require("path");
+
+function loadPrettier() {
+  const name = process.env.PRETTIER_MODULE || "prettier";
+  const paths = [process.cwd(), __dirname, ...(process.env.NODE_PATH || "").split(path.delimiter)];
+  return require(require.resolve(name, { paths: paths.filter(Boolean) }));
+}
+
+async function resolveConfig(filepath) {
+  if (!filepath || !prettier.resolveConfig) return null;
+  // No cache, so edits to config files apply without restarting the worker
+  return prettier.resolveConfig(filepath, { useCache: false, editorconfig: true });
+}
+
+function send(message) {
+  process.stdout.write(JSON.stringify(message) + "\n");
+}
+
+let prettier;
+try {
+  prettier = loadPrettier();
+} catch (error) {
+  send({ ready: false, error: String(error && error.message) });
+  process.exit(1);
+}
+
+send({ ready: true, version: prettier.version || null });
+
+const lines = readline.createInterface({ input: process.stdin, terminal: false });
+
+lines.on("line", async (line) => {
+  if (!line.trim()) return;
+
+  let request;
+  try {
+    request = JSON.parse(line);
+  } catch (error) {
+    send({ id: null, ok: false, error: `Invalid request: ${error.message}` });
+    return;
+  }
+
+  try {
+    if ("resolveConfig" in request) {
+      send({ id: request.id, ok: true, config: await resolveConfig(request.resolveConfig) });
+      return;
+    }
+
+    const options = request.options || {};
+    const config = request.resolved ? null : await resolveConfig(options.filepath);
+    // prettier 3 formats asynchronously, prettier 2 synchronously
+    const text = await prettier.format(request.text, { ...config, ...options });
+    send({ id: request.id, ok: true, text });
+  } catch (error) {
+    send({ id: request.id, ok: false, error: String(error && error.message) });
+  }
+});
+
+lines.on("close", () => process.exit(0));